@@ -0,0 +1,103 @@
+import numpy as np
+
+from surfdist import analysis, utils
+
+from . import meshes
+
+
+class DistCalc(object):
+    params = (meshes.sizes, ['exact', 'dijkstra', 'heat'])
+    param_names = ['n_vertices', 'method']
+    number = 1
+    repeat = 3
+    timeout = 600
+
+    def setup(self, n_vertices, method):
+        surf = meshes.icosphere(n_vertices)
+        cortex = meshes.cortex(surf)
+        self.mesh = utils.CortexMesh(surf, cortex)
+        self.src = cortex[meshes.labels(surf, 8)[cortex] == 1]
+        # graph construction and factorization are one-off costs per mesh, keep them out of the timing
+        analysis.dist_calc(self.mesh, None, self.src, method=method)
+
+    def time_dist_calc(self, n_vertices, method):
+        analysis.dist_calc(self.mesh, None, self.src, method=method)
+
+    def peakmem_dist_calc(self, n_vertices, method):
+        analysis.dist_calc(self.mesh, None, self.src, method=method)
+
+
+class DistCalcLocal(object):
+    params = (meshes.sizes, [10., 30.])
+    param_names = ['n_vertices', 'max_distance']
+    number = 1
+    repeat = 3
+    timeout = 600
+
+    def setup(self, n_vertices, max_distance):
+        surf = meshes.icosphere(n_vertices)
+        self.mesh = utils.CortexMesh(surf, meshes.cortex(surf))
+        self.src = self.mesh.cortex[:1]
+
+    def time_dist_calc(self, n_vertices, max_distance):
+        analysis.dist_calc(self.mesh, None, self.src, max_distance=max_distance)
+
+
+class DistCalcMatrix(object):
+    params = (meshes.sizes, [8, 32], ['min', 'mean'])
+    param_names = ['n_vertices', 'n_labels', 'summary']
+    number = 1
+    repeat = 1
+    timeout = 3600
+
+    def setup(self, n_vertices, n_labels, summary):
+        surf = meshes.icosphere(n_vertices)
+        self.mesh = utils.CortexMesh(surf, meshes.cortex(surf))
+        self.annot = meshes.annot_file(surf, n_labels)
+
+    def time_dist_calc_matrix(self, n_vertices, n_labels, summary):
+        analysis.dist_calc_matrix(self.mesh, None, self.annot, summary=summary, verbose=False)
+
+    def peakmem_dist_calc_matrix(self, n_vertices, n_labels, summary):
+        analysis.dist_calc_matrix(self.mesh, None, self.annot, summary=summary, verbose=False)
+
+
+class ZoneCalc(object):
+    params = (meshes.sizes[:3], [8, 32])
+    param_names = ['n_vertices', 'n_sources']
+    number = 1
+    repeat = 1
+    timeout = 3600
+
+    def setup(self, n_vertices, n_sources):
+        surf = meshes.icosphere(n_vertices)
+        self.mesh = utils.CortexMesh(surf, meshes.cortex(surf))
+        step = len(self.mesh.cortex) // n_sources
+        self.src = [self.mesh.cortex[[i * step]] for i in range(n_sources)]
+
+    def time_zone_calc(self, n_vertices, n_sources):
+        analysis.zone_calc(self.mesh, None, self.src)
+
+    def peakmem_zone_calc(self, n_vertices, n_sources):
+        analysis.zone_calc(self.mesh, None, self.src)
+
+
+class DistanceFieldEdit(object):
+    # removing and adding back a few nodes inside a source label
+    params = meshes.sizes[:3]
+    param_names = ['n_vertices']
+    number = 1
+    repeat = 3
+    timeout = 600
+
+    def setup(self, n_vertices):
+        surf = meshes.icosphere(n_vertices)
+        mesh = utils.CortexMesh(surf, meshes.cortex(surf))
+        label = mesh.cortex[meshes.labels(surf, 8)[mesh.cortex] == 1]
+        self.field = analysis.DistanceField(mesh, None, label)
+        centre = surf[0][label].mean(axis=0)
+        self.edit = label[np.argsort(np.linalg.norm(surf[0][label] - centre, axis=1))[:10]]
+
+    def time_remove_add(self, n_vertices):
+        self.field.remove_sources(self.edit)
+        self.field.add_sources(self.edit)
@@ -0,0 +1,34 @@
+import numpy as np
+
+from surfdist import sample, utils
+
+from . import meshes
+
+
+class SampleSimple(object):
+    # downsampling to a mesh with a quarter of the vertices, for one map and a 100 column time series
+    params = (meshes.sizes[1:], [1, 100])
+    param_names = ['n_vertices', 'n_columns']
+
+    def setup(self, n_vertices, n_columns):
+        surf = meshes.icosphere(n_vertices)
+        simple = meshes.icosphere(meshes.sizes[meshes.sizes.index(n_vertices) - 1])[0]
+        self.vertices = surf[0]
+        self.graph = utils.surf_graph(*surf)
+        # icospheres are nested, the simple vertices are the first vertices of the complex one
+        self.seeds = np.arange(len(simple))
+        self.labels = sample.competetive_fast_marching(self.vertices, self.graph, self.seeds)[:, 1]
+        self.averaging = sample.averaging_matrix(self.labels)
+        self.data = np.random.default_rng(0).random((n_vertices, n_columns))
+
+    def time_competetive_fast_marching(self, n_vertices, n_columns):
+        sample.competetive_fast_marching(self.vertices, self.graph, self.seeds)
+
+    def time_sample_simple(self, n_vertices, n_columns):
+        sample.sample_simple(self.data, self.labels)
+
+    def time_sample_simple_cached(self, n_vertices, n_columns):
+        sample.sample_simple(self.data, self.averaging)
+
+    def peakmem_sample_simple(self, n_vertices, n_columns):
+        sample.sample_simple(self.data, self.labels)
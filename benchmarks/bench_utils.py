@@ -0,0 +1,57 @@
+import numpy as np
+
+from surfdist import utils
+
+from . import meshes
+
+
+class MeshPreparation(object):
+    params = meshes.sizes
+    param_names = ['n_vertices']
+
+    def setup(self, n_vertices):
+        self.surf = meshes.icosphere(n_vertices)
+        self.cortex = meshes.cortex(self.surf)
+        self.mesh = utils.CortexMesh(self.surf, self.cortex)
+        self.src = self.cortex[meshes.labels(self.surf, 8)[self.cortex] == 1]
+        self.data = np.random.default_rng(0).random(len(self.cortex))
+
+    def time_surf_keep_cortex(self, n_vertices):
+        utils.surf_keep_cortex(self.surf, self.cortex)
+
+    def peakmem_surf_keep_cortex(self, n_vertices):
+        utils.surf_keep_cortex(self.surf, self.cortex)
+
+    def time_cortex_mesh(self, n_vertices):
+        utils.CortexMesh(self.surf, self.cortex)
+
+    def time_translate_src(self, n_vertices):
+        utils.translate_src(self.src, self.cortex)
+
+    def time_cortex_mesh_translate(self, n_vertices):
+        self.mesh.translate(self.src)
+
+    def time_recort(self, n_vertices):
+        utils.recort(self.data, self.surf, self.cortex)
+
+    def time_surf_graph(self, n_vertices):
+        utils.surf_graph(*self.surf)
+
+
+class FindNodeMatch(object):
+    # template mesh with a quarter of the vertices of the native mesh
+    params = meshes.sizes[1:]
+    param_names = ['n_vertices']
+    timeout = 300
+
+    def setup(self, n_vertices):
+        rng = np.random.default_rng(0)
+        native = meshes.icosphere(n_vertices)[0]
+        self.native = native + rng.normal(scale=.1, size=native.shape)
+        self.template = meshes.icosphere(meshes.sizes[meshes.sizes.index(n_vertices) - 1])[0]
+
+    def time_find_node_match(self, n_vertices):
+        utils.find_node_match(self.template, self.native)
+
+    def peakmem_find_node_match(self, n_vertices):
+        utils.find_node_match(self.template, self.native)
@@ -0,0 +1,58 @@
+import io
+
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+
+from surfdist import viz
+
+from . import meshes
+
+
+class Viz(object):
+    params = meshes.sizes
+    param_names = ['n_vertices']
+    number = 1
+    repeat = 3
+    timeout = 600
+
+    def setup(self, n_vertices):
+        self.coords, self.faces = meshes.icosphere(n_vertices)
+        self.stat_map = self.coords[:, 2].copy()
+        self.bg_map = self.coords[:, 1].copy()
+
+    def teardown(self, n_vertices):
+        plt.close('all')
+
+    def time_viz(self, n_vertices):
+        viz.viz(self.coords, self.faces, self.stat_map, bg_map=self.bg_map, bg_on_stat=True)
+
+    def peakmem_viz(self, n_vertices):
+        viz.viz(self.coords, self.faces, self.stat_map, bg_map=self.bg_map, bg_on_stat=True)
+
+
+class SurfaceRenderer(object):
+    # two views of two maps with one renderer, written to png
+    params = meshes.sizes
+    param_names = ['n_vertices']
+    number = 1
+    repeat = 3
+    timeout = 600
+
+    def setup(self, n_vertices):
+        self.coords, self.faces = meshes.icosphere(n_vertices)
+        self.stat_maps = [self.coords[:, 2].copy(), self.coords[:, 0].copy()]
+        self.bg_map = self.coords[:, 1].copy()
+        self.buffer = io.BytesIO()
+
+    def time_render_views(self, n_vertices):
+        renderer = viz.SurfaceRenderer(self.coords, self.faces, headless=True)
+        for stat_map in self.stat_maps:
+            for azim in (0, 180):
+                renderer.render(stat_map, azim=azim, bg_map=self.bg_map, bg_on_stat=True)
+                renderer.savefig(self.buffer, format='png')
+                self.buffer.seek(0)
+
+    def time_face_colors(self, n_vertices):
+        renderer = viz.SurfaceRenderer(self.coords, self.faces, headless=True)
+        renderer.face_colors(self.stat_maps[0], bg_map=self.bg_map, bg_on_stat=True)
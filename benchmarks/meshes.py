@@ -0,0 +1,78 @@
+"""
+Synthetic cortex-like meshes for the benchmarks, no FreeSurfer data needed.
+"""
+import functools
+import os
+import tempfile
+
+import nibabel as nib
+import numpy as np
+
+# number of vertices of an icosphere after 4 to 7 subdivisions (fsaverage5 has 10242 per hemisphere,
+# fsaverage 163842)
+sizes = [2562, 10242, 40962, 163842]
+
+radius = 80.
+
+
+@functools.lru_cache(maxsize=None)
+def icosphere(n_vertices, radius=radius):
+    """
+    Triangulated sphere with n_vertices (one of sizes, or any 10 * 4 ** k + 2) built by subdividing
+    an icosahedron. Also used by the tests; the arrays are cached, so callers must not modify them.
+    """
+    t = (1. + np.sqrt(5.)) / 2.
+    vertices = np.array([[-1, t, 0], [1, t, 0], [-1, -t, 0], [1, -t, 0],
+                         [0, -1, t], [0, 1, t], [0, -1, -t], [0, 1, -t],
+                         [t, 0, -1], [t, 0, 1], [-t, 0, -1], [-t, 0, 1]], dtype=np.float64)
+    faces = np.array([[0, 11, 5], [0, 5, 1], [0, 1, 7], [0, 7, 10], [0, 10, 11],
+                      [1, 5, 9], [5, 11, 4], [11, 10, 2], [10, 7, 6], [7, 1, 8],
+                      [3, 9, 4], [3, 4, 2], [3, 2, 6], [3, 6, 8], [3, 8, 9],
+                      [4, 9, 5], [2, 4, 11], [6, 2, 10], [8, 6, 7], [9, 8, 1]], dtype=np.int64)
+
+    while len(vertices) < n_vertices:
+        n = len(vertices)
+        edges = np.sort(np.vstack([faces[:, [0, 1]], faces[:, [1, 2]], faces[:, [2, 0]]]), axis=1)
+        keys, inverse = np.unique(edges[:, 0] * n + edges[:, 1], return_inverse=True)
+        start, end = np.divmod(keys, n)
+        vertices = np.vstack([vertices, (vertices[start] + vertices[end]) / 2.])
+        a, b, c = faces.T
+        ab, bc, ca = (inverse.reshape(3, -1) + n)
+        faces = np.vstack([np.c_[a, ab, ca], np.c_[b, bc, ab], np.c_[c, ca, bc], np.c_[ab, bc, ca]])
+
+    if len(vertices) != n_vertices:
+        raise ValueError('no icosphere with %d vertices' % n_vertices)
+    vertices = radius * vertices / np.linalg.norm(vertices, axis=1)[:, None]
+    return vertices, faces.astype(np.int32)
+
+
+def cortex(surf):
+    """
+    Cortex indices excluding a fake medial wall, a cap of about 10% of the sphere.
+    """
+    return np.where(surf[0][:, 0] < .8 * radius)[0]
+
+
+def labels(surf, n_labels):
+    """
+    Parcellation of the sphere into n_labels longitudinal wedges, 0 on the fake medial wall.
+    """
+    vertices = surf[0]
+    angle = np.arctan2(vertices[:, 1], vertices[:, 2])
+    parcels = 1 + np.digitize(angle, np.linspace(-np.pi, np.pi, n_labels + 1)[1:-1])
+    parcels[vertices[:, 0] >= .8 * radius] = 0
+    return parcels
+
+
+def annot_file(surf, n_labels):
+    """
+    Write labels(surf, n_labels) as a freesurfer annotation with 'Medial_wall' and return its path.
+    """
+    names = ['Medial_wall'] + ['L%d' % i for i in range(n_labels)]
+    ctab = np.zeros((len(names), 5), dtype=np.int32)
+    ctab[:, 0] = np.arange(len(names)) % 256
+    ctab[:, 1] = np.arange(len(names)) // 256
+    ctab[:, 4] = ctab[:, 0] + ctab[:, 1] * 2 ** 8
+    filename = os.path.join(tempfile.mkdtemp(), 'lh.bench.annot')
+    nib.freesurfer.write_annot(filename, labels(surf, n_labels), ctab, names)
+    return filename
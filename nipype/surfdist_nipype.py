@@ -13,68 +13,89 @@ def trimming(itemz, phrase):
   item = [x for x in itemz if phrase in x][0]
   return item
 
-def genfname(hemi, source, target):
-  fname = hemi + '_' + source + '_' + target
+def genfname(hemi, target):
+  fname = hemi + '_' + target
   return fname
 
-def calc_surfdist(surface, labels, annot, reg, origin, target):
+def match_nodes(reg, target):
+  import os
+  import numpy as np
+  import nibabel as nib
+  from surfdist import utils
+
+  """ inputs:
+  reg - registration file of the subject (lh.sphere.reg)
+  target - registration file of the target surface (e.g. fsaverage4 lh.sphere.reg)
+
+  Matches target to native nodes once per subject, hemisphere and template,
+  the result is reused for all sources.
+  """
+
+  trg = nib.freesurfer.read_geometry(target)[0]
+  native = nib.freesurfer.read_geometry(reg)[0]
+  idx_trg_to_native = utils.find_node_match(trg, native)[0]
+
+  filename = os.path.join(os.getcwd(),'idx_trg_to_native.npy')
+  np.save(filename, idx_trg_to_native)
+
+  return filename
+
+def calc_surfdist(surface, labels, annot, idx, origins, cache_dir=None, out_format='csv'):
   import nibabel as nib
   import numpy as np
   import os
-  from surfdist import load, utils, surfdist
-  import csv
+  from surfdist import load, utils, analysis
 
   """ inputs:
   surface - surface file (e.g. lh.pial, with full path)
   labels - label file (e.g. lh.cortex.label, with full path)
   annot - annot file (e.g. lh.aparc.a2009s.annot, with full path)
-  reg - registration file (lh.sphere.reg)
-  origin - the label from which we calculate distances
-  target - target surface (e.g. fsaverage4)
+  idx - file with the native node index of each target node (output of match_nodes)
+  origins - list of labels from which we calculate distances
+  cache_dir - optional directory of a distance cache shared across runs
+  out_format - output file format: 'csv', 'npy', 'hdf5' or 'gifti'
+
+  The surface and cortex mesh are loaded once for all origins.
+  Returns one file per origin, in the order of origins.
   """
 
   # Load stuff
   surf = nib.freesurfer.read_geometry(surface)
   cort = np.sort(nib.freesurfer.read_label(labels))
-  src  = load.load_freesurfer_label(annot, origin, cort)
+  mesh = utils.CortexMesh(surf, cort)
+  idx_trg_to_native = np.load(idx)
 
-  # Calculate distances
-  dist = surfdist.dist_calc(surf, cort, src)
+  filenames = []
+  for origin in origins:
+    src  = load.load_freesurfer_label(annot, origin)
 
-  # Project distances to target
-  trg = nib.freesurfer.read_geometry(target)[0]
-  native = nib.freesurfer.read_geometry(reg)[0]
-  idx_trg_to_native = utils.find_node_match(trg, native)[0]
+    # Calculate distances
+    dist = analysis.dist_calc(mesh, None, src, cache=cache_dir)
 
-  # Get indices in trg space 
-  distt = dist[idx_trg_to_native]
-  
-  # Write to file and return file handle
-  filename = os.path.join(os.getcwd(),'distances.csv')
-  distt.tofile(filename,sep=",")
+    # Get indices in trg space 
+    distt = dist[idx_trg_to_native]
 
-  return filename
+    # Write to file
+    filenames.append(load.save_dist(distt, os.path.join(os.getcwd(),'distances_' + origin), out_format))
 
-def stack_files(files, hemi, source, target):
+  return filenames
+
+def stack_files(files, hemi, sources, target, out_format='csv'):
   """
-  This function takes a list of files as input and vstacks them
+  This function takes a list of files per subject (one file per source) as input
+  and vstacks them per source into one file of the given format
+  ('csv', 'npy', 'hdf5' or 'gifti')
   """
-  import csv
   import os
-  import numpy as np
+  from surfdist import load
 
-  fname = "sdist_%s_%s_%s.csv" % (hemi, source, target)
-  filename = os.path.join(os.getcwd(),fname)
+  filenames = []
+  for i, source in enumerate(sources):
+    fname = "sdist_%s_%s_%s" % (hemi, source, target)
+    filenames.append(load.stack_dist([subject_files[i] for subject_files in files],
+                                     os.path.join(os.getcwd(),fname), out_format))
 
-  alldist = []
-
-  for dfile in files:
-    alldist.append(np.genfromtxt(dfile, delimiter=','))
-
-  alldist = np.array(alldist)
-  alldist.tofile(filename,",")
-
-  return filename
+  return filenames
 
 
 def create_surfdist_workflow(subjects_dir,
@@ -84,13 +105,15 @@ def create_surfdist_workflow(subjects_dir,
                              hemi,
                              atlas,
                              labs,
-                             name):
+                             name,
+                             cache_dir=None,
+                             out_format='csv'):
 
   sd = Workflow(name=name)
     
-  # Run a separate tree for each template, hemisphere and source structure
-  infosource = Node(IdentityInterface(fields=['template','hemi','source']), name="infosource")
-  infosource.iterables = [('template', target),('hemi', hemi),('source',sources)]
+  # Run a separate tree for each template and hemisphere, all sources are calculated together
+  infosource = Node(IdentityInterface(fields=['template','hemi']), name="infosource")
+  infosource.iterables = [('template', target),('hemi', hemi)]
 
   # Get template files
   fsst = Node(FreeSurferSource(),name='FS_Source_template')
@@ -100,11 +123,10 @@ def create_surfdist_workflow(subjects_dir,
   sd.connect(infosource,'hemi',fsst,'hemi')
 
   # Generate folder name for output
-  genfoldname = Node(Function(input_names=['hemi','source','target'],
+  genfoldname = Node(Function(input_names=['hemi','target'],
                       output_names=['cname'], function=genfname),
                       name='genfoldname')
   sd.connect(infosource,'hemi',genfoldname,'hemi')
-  sd.connect(infosource,'source',genfoldname,'source')
   sd.connect(infosource,'template',genfoldname,'target')
 
   # Get subjects
@@ -129,21 +151,30 @@ def create_surfdist_workflow(subjects_dir,
   tannot.inputs.phrase = atlas
   sd.connect(fss,'annot',tannot,'itemz')
 
-  # Calculate distances for each hemi
-  sdist = Node(Function(input_names=['surface','labels','annot','reg','origin','target'],
+  # Match template to native nodes once per subject, hemi and template
+  match = Node(Function(input_names=['reg','target'],
+                        output_names=['idx'], function=match_nodes),
+                        name='match')
+  sd.connect(fss,'sphere_reg',match,'reg')
+  sd.connect(fsst,'sphere_reg',match,'target')
+
+  # Calculate distances from all sources for each hemi
+  sdist = Node(Function(input_names=['surface','labels','annot','idx','origins','cache_dir','out_format'],
                         output_names=['distances'], function=calc_surfdist), 
                         name='sdist')
-  sd.connect(infosource,'source',sdist,'origin')
+  sdist.inputs.origins = sources
+  sdist.inputs.cache_dir = cache_dir
+  sdist.inputs.out_format = out_format
   sd.connect(fss,'pial',sdist,'surface')
   sd.connect(tlab,'item',sdist,'labels')
   sd.connect(tannot,'item',sdist,'annot')
-  sd.connect(fss,'sphere_reg',sdist,'reg')
-  sd.connect(fsst,'sphere_reg',sdist,'target')
+  sd.connect(match,'idx',sdist,'idx')
   
-  # Gather data for each hemi from all subjects
-  bucket = JoinNode(Function(input_names=['files','hemi','source','target'],output_names=['group_dist'], 
+  # Gather data for each hemi and source from all subjects
+  bucket = JoinNode(Function(input_names=['files','hemi','sources','target','out_format'],output_names=['group_dist'], 
                          function=stack_files), joinsource = fss, joinfield = 'files', name='bucket')
-  sd.connect(infosource,'source',bucket,'source')
+  bucket.inputs.sources = sources
+  bucket.inputs.out_format = out_format
   sd.connect(infosource,'template',bucket,'target')
   sd.connect(infosource,'hemi',bucket,'hemi')
   sd.connect(sdist,'distances',bucket,'files')
@@ -174,7 +205,9 @@ def create_workflow(args, name=None):
                   hemi = args.hemi,
                   atlas = args.annot,
                   labs = args.labels,
-                  name=name)
+                  name=name,
+                  cache_dir = args.cache_dir,
+                  out_format = args.out_format)
     wf = create_surfdist_workflow(**kwargs)
 
     return wf
@@ -213,6 +246,11 @@ subjects. This table can be used for permutation testing in PALM.''',
                         help="Output directory base")
     parser.add_argument("-w", "--work_dir", dest="work_dir",
                         help="Output directory base")
+    parser.add_argument("-c", "--cache_dir", dest="cache_dir",
+                        help="Directory of a distance cache reused across runs")
+    parser.add_argument("-f", "--format", dest="out_format",
+                        default='csv', choices=['csv', 'npy', 'hdf5', 'gifti'],
+                        help="Output file format, csv for PALM" + defstr)
     parser.add_argument("-p", "--plugin", dest="plugin",
                         default='Linear',
                         help="Plugin to use")
@@ -24,6 +24,6 @@ setuptools.setup(
   url = 'https://github.com/NeuroanatomyAndConnectivity/surfdist',
   keywords = ['geodesic', 'distance', 'brain', 'cortex'],
   license='LICENSE.txt',
-  python_requires='>=3.6',  
+  python_requires='>=3.8',
   install_requires=load_requirements("requirements.txt")
 )
@@ -1 +1 @@
-__all__ = ["load", "analysis", "utils", "viz", "sample"]
+__all__ = ["load", "analysis", "utils", "viz", "sample", "parallel", "cache", "geodesic", "group", "instrument", "stats"]
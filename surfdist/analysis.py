@@ -1,96 +1,600 @@
+import functools
+import time
 import gdist
 import numpy as np
-from surfdist.utils import surf_keep_cortex, translate_src, recort
+import scipy.sparse
+import scipy.spatial
+from scipy.sparse import csgraph
+from surfdist.utils import cortex_mesh
+from surfdist.parallel import map_sources
+from surfdist.cache import as_cache
+from surfdist import geodesic
 from surfdist import load
+from surfdist.instrument import stage
 
 
-def dist_calc(surf, cortex, source_nodes):
+def dist_calc(surf, cortex, source_nodes, cache = None, max_distance = None, method = 'exact',
+              dtype = np.float64, out = None, return_nearest = False):
 
     """
     Calculate exact geodesic distance along cortical surface from set of source nodes.
     "dist_type" specifies whether to calculate "min", "mean", "median", or "max" distance values
     from a region-of-interest. If running only on single node, defaults to "min".
+    "surf" can also be a utils.CortexMesh built once for the subject, in which case "cortex" is not used.
+    "cache" optionally is a cache.DistanceCache (or its directory) from which the distance field is
+    loaded if it was computed before for the same mesh, cortex and source nodes.
+    "max_distance" optionally bounds the propagation: distances are only computed up to this radius
+    and nodes further away are set to inf, which is much faster for local neighbourhoods.
+    "method" selects the geodesic engine: 'exact' (default), or the faster approximations 'dijkstra'
+    (shortest paths along mesh edges) and 'heat' (heat method); see geodesic.compute for their accuracy.
+    "dtype" sets the dtype of the returned distances; alternatively they are written into "out", an
+    array of shape (n_nodes,) such as a row of a float32 np.memmap, which is then returned.
+    "return_nearest" additionally returns the closest source node of every node (full surface indexing,
+    -1 on the medial wall and beyond max_distance), derived from the same distance field as in
+    DistanceField; this gives the zones of the individual source nodes without further solves.
+    The source is found by descending the distance field along mesh edges, which is exact for
+    method 'dijkstra' but approximate for geodesic distances: near the borders between zones a node
+    can get a source slightly farther away than its closest one. With 20 random source nodes on a
+    10242 node icosphere of radius 80 mm, 0.7 % of the nodes got such a source, at most 1.9 mm
+    farther away. zone_calc gives exact zones at the cost of one solve per source.
+    The stages are timed by instrument.record.
     """
 
-    cortex_vertices, cortex_triangles = surf_keep_cortex(surf, cortex)
-    translated_source_nodes = translate_src(source_nodes, cortex)
-    data = gdist.compute_gdist(cortex_vertices, cortex_triangles, source_indices = translated_source_nodes)
-    dist = recort(data, surf, cortex)
+    with stage('surf_keep_cortex'):
+        mesh = cortex_mesh(surf, cortex)
+    with stage('translate_src'):
+        translated_source_nodes = mesh.translate(source_nodes)
+    data = _solve(mesh.vertices, mesh.triangles, translated_source_nodes, max_distance = max_distance,
+                  method = method, **_cache_args(mesh, cache))
+    with stage('recort'):
+        dist = mesh.recort(data, dtype = dtype, out = out)
+    if return_nearest:
+        with stage('nearest'):
+            nearest = mesh.recort_nodes(_nearest_sources(mesh.graph, data, translated_source_nodes))
+        return dist, nearest
     del data
 
     return dist
 
 
-def zone_calc(surf, cortex, src):
+def zone_calc(surf, cortex, src, n_jobs = 1, progress = None, cancel = None):
     """
     Calculate closest nodes to each source node using exact geodesic distance along the cortical surface.
+    "src" is a list of source node arrays; each node is labelled with the (1-based) position in "src" of
+    its closest source, the medial wall is labelled 0. Ties go to the earlier source.
+    The distance fields are folded into a running minimum as they are computed, so memory does not
+    grow with the number of sources. dist_calc with return_nearest gives the zones of single source
+    nodes from one solve, assigned along the mesh edges and so approximate near the zone borders.
+    "n_jobs" sets the number of worker processes the per-source solves are spread over
+    (1 runs serially, -1 uses all cores).
+    "surf" can also be a utils.CortexMesh built once for the subject, in which case "cortex" is not used.
+    The stages are timed by instrument.record.
+    "progress" is an optional function called as progress(n_done, n_total, eta) after each source,
+    with the estimated remaining time in seconds.
+    "cancel" is an optional token such as a threading.Event, checked before each solve. If it is given,
+    zone_calc returns (zone, completed), where the boolean array completed marks the sources that
+    were solved; once the token is set the remaining sources are skipped and zone only assigns nodes
+    to the completed sources.
     """
 
-    cortex_vertices, cortex_triangles = surf_keep_cortex(surf, cortex)
+    with stage('surf_keep_cortex'):
+        mesh = cortex_mesh(surf, cortex)
 
-    dist_vals = np.zeros((len(source_nodes), len(cortex_vertices)))
+    completed = np.zeros(len(src), dtype=bool)
+    min_dist = np.full(len(mesh.vertices), np.inf)
+    data = np.zeros(len(mesh.vertices), dtype=np.int64)
 
-    for x in range(len(source_nodes)):
+    with stage('translate_src'):
+        translated_sources = [mesh.translate(s) for s in src]
+    with stage('solves', n_sources = len(src), n_jobs = n_jobs):
+        fields = map_sources(_solve, mesh.vertices, mesh.triangles, translated_sources, n_jobs = n_jobs)
+        for x, field in enumerate(_monitor(fields, len(src), progress, cancel)):
+            with stage('summary', source = x):
+                closer = field < min_dist
+                min_dist[closer] = field[closer]
+                data[closer] = x + 1
+            completed[x] = True
 
-        translated_source_nodes = translate_src(source_nodes[x], cortex)
-        dist_vals[x, :] = gdist.compute_gdist(cortex_vertices, cortex_triangles, source_indices = translated_source_nodes)
-
-    data = np.argsort(dist_vals, axis=0)[0, :] + 1
-
-    zone = recort(data, surf, cortex)
+    with stage('recort'):
+        zone = mesh.recort(data)
 
     del data
 
+    if cancel is not None:
+        return zone, completed
     return zone
 
 
-def dist_calc_matrix(surf, cortex, labels, exceptions = ['Unknown', 'Medial_wall'], summary = 'min', verbose = True):
+def dist_calc_matrix(surf, cortex, labels, exceptions = ['Unknown', 'Medial_wall'], summary = 'min', verbose = True,
+                     n_jobs = 1, cache = None, max_distance = None, method = 'exact', dtype = np.float64, out = None,
+                     progress = None, cancel = None, completed = None):
     """
     Calculate exact geodesic distance along cortical surface from set of source nodes.
     "labels" specifies the freesurfer label file to use. All values will be used other than those
-    specified in "exceptions" (default: 'Unknown' and 'Medial_Wall').
+    specified in "exceptions" (default: 'Unknown' and 'Medial_Wall'). Label names are decoded to str
+    before they are compared with "exceptions"; earlier versions compared the raw bytes names, so
+    no region was ever excluded and the matrix included 'Unknown' and 'Medial_wall'.
     summary defines how the distances are summarized with suppoted values: 'min', 'mean', 'median', 'max'
 
+    The annotation is read once and the distance field of each region is reduced to its
+    summary values as soon as it is computed, so only one distance field is held in memory
+    at a time regardless of the number of regions.
+    "n_jobs" sets the number of worker processes the per-region solves are spread over
+    (1 runs serially, -1 uses all cores); results are identical to the serial run.
+    "surf" can also be a utils.CortexMesh built once for the subject, in which case "cortex" is not used.
+    "cache" optionally is a cache.DistanceCache (or its directory) holding the distance field of each
+    region, so reruns on the same mesh and annotation skip the solves.
+    "max_distance" optionally bounds the propagation from each region; nodes further away count as
+    inf, so pairs of regions further apart than max_distance get inf (or a mean of inf).
+    "method" selects the geodesic engine as in dist_calc. With 'heat', each worker factorizes the
+    mesh once and reuses the factorization for all its regions.
+    "dtype" sets the dtype of dist_mat; alternatively it is written into "out", an array of shape
+    (n_regions, n_regions).
+
+    With summary 'min' the matrix is symmetric, so the solve from each region only has to reach the
+    regions after it, and the last region needs no solve at all. Exact solves stop propagating at the
+    largest of the shortest edge-path distances to those regions, which is an upper bound of their
+    geodesic distance. Per-region minima are taken with np.minimum.reduceat over the region-sorted nodes.
+
+    The stages (reading the annotation, each solve and summary, ...) are timed by instrument.record.
+
+    "progress" is an optional function called as progress(n_done, n_total, eta) after each region,
+    with the estimated remaining time in seconds.
+    "cancel" is an optional token such as a threading.Event, checked before each solve. Once it is set
+    the remaining regions are skipped; the entries they would have filled are nan.
+    "completed" resumes a cancelled run: pass the completed mask it returned along with its dist_mat
+    as "out", and only the remaining regions are solved.
+
     returns:
       dist_mat: symmetrical nxn matrix of minimum distance between pairs of labels
-      rois: label names in order of n
+      rois: label names (str, earlier versions returned bytes) in order of n
+      completed: only returned if "cancel" is given, boolean array marking the regions that were
+                 solved. The solve of region i fills column i, with summary 'min' the entries (i, j)
+                 and (j, i) for j > i.
     """
 
-    cortex_vertices, cortex_triangles = surf_keep_cortex(surf, cortex)
+    summarize = _summaries.get(summary)
+    if summarize is None:
+        raise ValueError(f'undefined summary: {summary}')
+    if method not in geodesic.methods:
+        raise ValueError(f'undefined method: {method}')
+    if completed is not None and out is None:
+        raise ValueError('completed requires the partial dist_mat as out')
+
+    with stage('surf_keep_cortex'):
+        mesh = cortex_mesh(surf, cortex)
 
     # remove exceptions from label list:
-    label_list = load.get_freesurfer_label(labels, verbose = False)
+    with stage('read_annotation'):
+        annot = load.read_annotation(labels)
+    label_list = annot.label_names
     rs = np.where([a not in exceptions for a in label_list])[0]
     rois = [label_list[r] for r in rs]
     if verbose:
         print("# of regions: " + str(len(rois)))
 
-    # calculate distance from each region to all nodes:
-    dist_roi = []
-    for roi in rois:
-        source_nodes = load.load_freesurfer_label(labels, roi)
-        translated_source_nodes = translate_src(source_nodes, cortex)
-        dist_roi.append(gdist.compute_gdist(cortex_vertices, cortex_triangles,
-                                                source_indices = translated_source_nodes))
-        if verbose:
-            print(roi)
-    dist_roi = np.array(dist_roi)
-
-    # Calculate min distance per region:
-    dist_mat = []
-    for roi in rois:
-        source_nodes = load.load_freesurfer_label(labels, roi)
-        translated_source_nodes = translate_src(source_nodes, cortex)
-        if summary == 'min':
-            dist_mat.append(np.min(dist_roi[:,translated_source_nodes], axis = 1))
-        elif summary == 'mean':
-            dist_mat.append(np.mean(dist_roi[:,translated_source_nodes], axis = 1))
-        elif summary == 'median':
-            dist_mat.append(np.median(dist_roi[:,translated_source_nodes], axis = 1))
-        elif summary == 'max':
-            dist_mat.append(np.max(dist_roi[:,translated_source_nodes], axis = 1))
-        else:
-            raise(f'undefined summary: {summary}')
-    dist_mat = np.array(dist_mat)
+    # nodes of each region, translated to the surface without medial wall:
+    with stage('translate_src'):
+        roi_nodes = [mesh.translate(annot.label_nodes(r)) for r in rs]
+
+    # calculate distance from each region to all nodes and summarize per region:
+    if out is None:
+        dist_mat = np.zeros((len(rois), len(rois)), dtype = dtype)
+    else:
+        if out.shape != (len(rois), len(rois)):
+            raise ValueError('out must have shape (%d, %d), got %s' % (len(rois), len(rois), out.shape))
+        dist_mat = out
+        if completed is None:
+            dist_mat[...] = 0
+    if completed is None:
+        completed = np.zeros(len(rois), dtype=bool)
+    else:
+        completed = np.array(completed, dtype=bool)
+    todo = np.where(~completed)[0]
+
+    if summary == 'min':
+        # nodes of all regions sorted by region, with the number of nodes per region
+        region_nodes = np.concatenate(roi_nodes) if roi_nodes else np.zeros(0, dtype=np.int32)
+        region_sizes = np.array([len(nodes) for nodes in roi_nodes], dtype=np.int64)
+        solve = functools.partial(_min_to_later_regions, roi_nodes = roi_nodes, region_nodes = region_nodes,
+                                  region_sizes = region_sizes, max_distance = max_distance, method = method,
+                                  **_cache_args(mesh, cache))
+        with stage('solves', n_sources = len(todo), n_jobs = n_jobs):
+            columns = map_sources(solve, mesh.vertices, mesh.triangles, todo, n_jobs = n_jobs)
+            for i, column in zip(todo, _monitor(columns, len(todo), progress, cancel)):
+                dist_mat[i + 1:, i] = column
+                dist_mat[i, i + 1:] = column
+                completed[i] = True
+                if verbose:
+                    print(rois[i])
+        # entries (i, j) are filled by the solve of region min(i, j)
+        filled = completed[np.minimum.outer(np.arange(len(rois)), np.arange(len(rois)))]
+        dist_mat[~filled] = np.nan
+        dist_mat[np.diag_indices_from(dist_mat)] = np.where(region_sizes > 0, 0., np.inf)
+        return _matrix_result(dist_mat, rois, completed, cancel)
+
+    solve = functools.partial(_summarize_regions, roi_nodes = roi_nodes, summarize = summarize,
+                              max_distance = max_distance, method = method, **_cache_args(mesh, cache))
+    with stage('solves', n_sources = len(todo), n_jobs = n_jobs):
+        columns = map_sources(solve, mesh.vertices, mesh.triangles, [roi_nodes[i] for i in todo], n_jobs = n_jobs)
+        for i, column in zip(todo, _monitor(columns, len(todo), progress, cancel)):
+            dist_mat[:, i] = column
+            completed[i] = True
+            if verbose:
+                print(rois[i])
+    dist_mat[:, ~completed] = np.nan
+
+    return _matrix_result(dist_mat, rois, completed, cancel)
+
+
+def local_dist_matrix(surf, cortex, max_distance):
+    """
+    Calculate exact geodesic distances between all pairs of nodes that are at most "max_distance" apart.
+    Returns a symmetric scipy.sparse.csr_matrix of shape (n_nodes, n_nodes) in full surface indexing;
+    rows and columns of medial wall nodes are empty. The matrix can be stored and reloaded with
+    scipy.sparse.save_npz and scipy.sparse.load_npz.
+    Memory grows with the number of pairs within "max_distance", roughly n_nodes x the number of nodes
+    in a disc of that radius.
+    "surf" can also be a utils.CortexMesh built once for the subject, in which case "cortex" is not used.
+    """
+
+    mesh = cortex_mesh(surf, cortex)
+    local = gdist.local_gdist_matrix(mesh.vertices, mesh.triangles, max_distance = max_distance).tocsr()
+    local.data[local.data > max_distance] = 0
+    local.eliminate_zeros()
+
+    # spread the cortex rows over the full surface, medial wall rows stay empty
+    indptr = np.zeros(mesh.n_nodes + 1, dtype=local.indptr.dtype)
+    indptr[mesh.cortex + 1] = np.diff(local.indptr)
+    np.cumsum(indptr, out=indptr)
+    indices = mesh.cortex[local.indices].astype(local.indices.dtype)
+
+    return scipy.sparse.csr_matrix((local.data, indices, indptr), shape=(mesh.n_nodes, mesh.n_nodes))
+
+
+class DistanceField(object):
+    """
+    Geodesic distance from a set of source nodes that is updated as nodes are added to or removed
+    from the set, e.g. while a label is edited, without solving from all sources again.
+
+    The distance from a set is the minimum over its members. Added nodes are solved on their own and
+    folded in with an elementwise minimum. Removing nodes only changes the nodes whose distance was
+    attained by a removed source; they are solved again from the remaining sources that can reach
+    them within a radius bounded by shortest edge paths from the unchanged nodes around them, as in
+    dist_calc_matrix. Updates give the same distances as a full solve from the new set of sources.
+
+    The solves for added and removed nodes propagate only around them as long as the nodes they
+    change stay nearby, which makes edits inside a label a fraction of the cost of a full solve.
+    Adding or removing nodes at the border of a label changes the distances in a wedge reaching
+    across the surface; once the bounded solves are known not to contain the change, the field is
+    solved again from all sources, so such an edit costs about one full solve.
+
+    The nearest source of each node follows from the distance field: every node points to the
+    neighbour it is reached from (the one minimizing distance plus edge length among those with a
+    smaller distance), and the pointers are followed down to a source. Nodes where this descent
+    does not end in a source are labelled from shortest edge paths instead.
+
+    Inputs
+    -------
+    surf : surface (vertices, triangles), or a utils.CortexMesh in which case cortex is not used
+    cortex : indices of the cortex nodes
+    source_nodes : initial source nodes (full surface indexing), may be empty
+    method : 'exact' (default) or 'dijkstra', see geodesic.compute
+
+    Attributes
+    -------
+    mesh : the utils.CortexMesh of the surface
+    sources : sorted source nodes (full surface indexing)
+    distance : distance of each node to the closest source, as returned by dist_calc
+    nearest : closest source node of each node (full surface indexing), -1 on the medial wall and
+              for nodes no source reaches
+    """
+
+    def __init__(self, surf, cortex, source_nodes, method = 'exact'):
+        if method not in ('exact', 'dijkstra'):
+            raise ValueError(f'undefined method for incremental updates: {method}')
+        self.mesh = cortex_mesh(surf, cortex)
+        self.method = method
+        self._graph = self.mesh.graph
+        self._sources = np.zeros(0, dtype=np.int32)
+        self._field = np.full(len(self.mesh.vertices), np.inf)
+        self._nearest = np.full(len(self.mesh.vertices), -1, dtype=np.int32)
+        self.add_sources(source_nodes)
+
+    @property
+    def sources(self):
+        return self.mesh.cortex[self._sources]
+
+    @property
+    def distance(self):
+        return self.mesh.recort(self._field)
+
+    @property
+    def nearest(self):
+        return self.mesh.recort_nodes(self._nearest)
+
+    def add_sources(self, source_nodes):
+        """
+        Add source nodes (full surface indexing); nodes that are already sources are ignored.
+        """
+        added = np.setdiff1d(self.mesh.translate(source_nodes), self._sources)
+        if len(added) == 0:
+            return
+
+        # nodes that get closer are reached from the added sources through nodes that get closer
+        grown = self._grow(added, self._ring(np.isin(np.arange(len(self._field)), added)),
+                           lambda field: field < self._field)
+        self._sources = np.union1d(self._sources, added).astype(np.int32)
+        if grown is None:
+            self._solve_all()
+            return
+
+        field, closer = grown
+        self._field[closer] = field[closer]
+        self._nearest[closer] = _nearest_sources(self._graph, field, added)[closer]
+
+    def remove_sources(self, source_nodes):
+        """
+        Remove source nodes (full surface indexing); nodes that are not sources are ignored.
+        """
+        removed = np.intersect1d(self.mesh.translate(source_nodes), self._sources)
+        if len(removed) == 0:
+            return
+        self._sources = np.setdiff1d(self._sources, removed).astype(np.int32)
+        if len(self._sources) == 0:
+            self._solve_all()
+            return
+
+        # nodes whose distance was attained by a removed source get a larger distance, they lie
+        # around the nodes labelled with the removed sources; they are solved again afterwards, so
+        # this solve may only reach half of the mesh
+        grown = self._grow(removed, self._ring(np.isin(self._nearest, removed)),
+                           lambda field: field <= self._field * (1 + 1e-9) + 1e-9, budget = .5)
+        if grown is None:
+            self._solve_all()
+            return
+        field, affected = grown
+        spent = np.isfinite(field).mean()
+        # nodes still labelled with a removed source keep their distance but get a new nearest source
+        relabel = affected | np.isin(self._nearest, removed)
+
+        # the new distance of an affected node is at most the distance of an unchanged node next to
+        # the affected region plus the shortest edge path from there, and shortest edge paths are
+        # never shorter than geodesic paths (see _min_to_later_regions)
+        unchanged = self._ring(affected, 1) & ~affected & np.isfinite(self._field)
+        bound = self._field[relabel & ~affected].max(initial = 0.)
+        if unchanged.any():
+            nodes = np.flatnonzero(affected | unchanged)
+            paths = csgraph.dijkstra(self._graph[nodes][:, nodes], directed = False, min_only = True,
+                                     indices = np.flatnonzero(unchanged[nodes]))
+            paths = paths[np.isfinite(paths)]
+            bound = max(bound, self._field[unchanged].max() + paths.max(initial = 0.))
+        radius = bound * (1 + 1e-6) + 1e-6
+        if not radius < self._field[~affected].max(initial = 0.):
+            self._solve_all()
+            return
+
+        # only sources within the radius of the relabelled nodes can be their nearest, geodesic
+        # distances are never shorter than euclidean ones
+        tree = scipy.spatial.cKDTree(self.mesh.vertices[relabel])
+        near, _ = tree.query(self.mesh.vertices[self._sources], distance_upper_bound = radius)
+        candidates = self._sources[np.isfinite(near)]
+        if self.method == 'exact' and len(candidates):
+            # solve from all sources if the two bounded solves together cover more than the mesh
+            reach = np.isfinite(_gdist(self.mesh.vertices, self.mesh.triangles, candidates,
+                                       max_distance = radius, method = 'dijkstra')).mean()
+            if spent + reach > 1:
+                self._solve_all()
+                return
+
+        self._field[affected] = np.inf
+        self._nearest[relabel] = -1
+        if len(candidates) == 0:
+            return
+        field = _gdist(self.mesh.vertices, self.mesh.triangles, candidates, max_distance = radius,
+                       method = self.method)
+        self._field[affected] = field[affected]
+        self._nearest[relabel] = _nearest_sources(self._graph, field, candidates)[relabel]
+
+    def _solve_all(self):
+        # solve from all sources again, for edits that change the distances in much of the mesh
+        self._field = np.full(len(self.mesh.vertices), np.inf)
+        if len(self._sources):
+            self._field = _gdist(self.mesh.vertices, self.mesh.triangles, self._sources, method = self.method)
+        self._nearest = _nearest_sources(self._graph, self._field, self._sources)
+
+    def _ring(self, nodes, n_rings = 2):
+        # boolean mask of nodes grown by n_rings rings of neighbours
+        nodes = nodes.copy()
+        for _ in range(n_rings):
+            nodes[self._graph[np.flatnonzero(nodes)].indices] = True
+        return nodes
+
+    def _grow(self, source_nodes, near, changes, budget = 1.):
+        """
+        Field of source_nodes and the mask of nodes where changes(field) holds, i.e. whose distance
+        is taken over from these sources. The solve propagates up to the largest current distance in
+        near plus a margin. The changed nodes are reached through changed nodes, so they are all found
+        if they stay clear of the radius by two edge lengths. Returns None otherwise, e.g. when a
+        source at the border of a label changes the distances in a wedge reaching across the surface,
+        or when the solve would reach more than the fraction budget of the nodes; then solving from
+        all sources is cheaper.
+        """
+        margin = 2 * self._graph.data.max() if self._graph.nnz else 0.
+        radius = self._field[near].max() + 2 * margin if near.any() else margin
+        if not radius < self._field.max():
+            return None
+        if self.method == 'exact':
+            # shortest edge paths are cheap and never shorter than geodesic paths, so the nodes they
+            # get closer are closer in the exact solve too: a change reaching the radius, and the
+            # part of the mesh the solve covers, show up before the exact solve is run
+            field = _gdist(self.mesh.vertices, self.mesh.triangles, source_nodes, max_distance = radius,
+                           method = 'dijkstra')
+            if (field[changes(field)] > radius - margin).any() or np.isfinite(field).mean() > budget:
+                return None
+        field = _gdist(self.mesh.vertices, self.mesh.triangles, source_nodes, max_distance = radius,
+                       method = self.method)
+        changed = changes(field)
+        if (field[changed] > radius - margin).any():
+            return None
+        return field, changed
 
+
+def _monitor(results, n_total, progress = None, cancel = None):
+    """
+    Yield from results until cancel is set, calling progress after each result has been consumed.
+    The cancel token is checked before the next result is requested, i.e. before its solve in a
+    serial run; results is closed on exit, which cancels the tasks still pending in map_sources.
+    """
+    start = time.perf_counter()
+    n_done = 0
+    try:
+        while cancel is None or not cancel.is_set():
+            try:
+                result = next(results)
+            except StopIteration:
+                return
+            yield result
+            n_done += 1
+            if progress is not None:
+                progress(n_done, n_total, (time.perf_counter() - start) / n_done * (n_total - n_done))
+    finally:
+        results.close()
+
+
+def _matrix_result(dist_mat, rois, completed, cancel):
+    if cancel is not None:
+        return dist_mat, rois, completed
     return dist_mat, rois
+
+
+def _gdist(vertices, triangles, source_nodes, max_distance = None, method = 'exact'):
+    """
+    Distance field of one set of (translated) source nodes, run by map_sources.
+    Nodes beyond max_distance are set to inf.
+    """
+    return geodesic.compute(vertices, triangles, source_nodes, method = method, max_distance = max_distance)
+
+
+def _solve(vertices, triangles, source_nodes, cache = None, mesh_key = None, **params):
+    """
+    Distance field of one set of (translated) source nodes, looked up in and added to cache if given.
+    params are passed on to _gdist; only those that differ from the defaults go into the cache key.
+    """
+    params = {name: value for name, value in params.items() if value not in (None, 'exact')}
+    with stage('solve', n_nodes = len(source_nodes), **params):
+        if cache is None:
+            return _gdist(vertices, triangles, source_nodes, **params)
+
+        key = cache.key(mesh_key, source_nodes, **params)
+        data = cache.get(key)
+        if data is None:
+            data = _gdist(vertices, triangles, source_nodes, **params)
+            cache.put(key, data)
+        return data
+
+
+def _cache_args(mesh, cache):
+    """
+    Keyword arguments of _solve for an optional cache on mesh.
+    """
+    cache = as_cache(cache)
+    if cache is None:
+        return {}
+    return dict(cache = cache, mesh_key = cache.mesh_key(mesh))
+
+
+def _summarize_regions(vertices, triangles, source_nodes, roi_nodes, summarize, **solve_args):
+    """
+    Reduce the distance field of one region to its summary distance to every region.
+    """
+    dist_roi = _solve(vertices, triangles, source_nodes, **solve_args)
+    with stage('summary'):
+        return np.array([summarize(dist_roi[nodes]) for nodes in roi_nodes])
+
+
+def _min_to_later_regions(vertices, triangles, roi, roi_nodes, region_nodes, region_sizes,
+                          max_distance = None, method = 'exact', **solve_args):
+    """
+    Minimum distance from region number roi to every region after it.
+    region_nodes holds the nodes of all regions sorted by region and region_sizes their counts.
+    """
+    start = region_sizes[:roi + 1].sum()
+    later_nodes, later_sizes = region_nodes[start:], region_sizes[roi + 1:]
+    if len(later_sizes) == 0:
+        return np.zeros(0)
+
+    radius = max_distance
+    if method == 'exact':
+        # shortest paths along edges are never shorter than geodesic paths, so the exact front
+        # has reached every later region once it passes the largest of their edge-path minima
+        with stage('solve', n_nodes = len(roi_nodes[roi]), method = 'dijkstra', max_distance = max_distance):
+            edge_dist = geodesic.compute(vertices, triangles, roi_nodes[roi], method = 'dijkstra',
+                                         max_distance = max_distance)
+        bound = _region_minima(edge_dist[later_nodes], later_sizes).max()
+        if np.isfinite(bound):
+            radius = bound * (1 + 1e-6) + 1e-6
+
+    field = _solve(vertices, triangles, roi_nodes[roi], max_distance = radius, method = method, **solve_args)
+    with stage('summary'):
+        return _region_minima(field[later_nodes], later_sizes)
+
+
+def _nearest_sources(graph, field, source_nodes):
+    """
+    Nearest source of each node reached by field, following the steepest descent of field along
+    the edges of graph (see DistanceField); -1 for nodes with infinite distance.
+    """
+    n = len(field)
+    nearest = np.full(n, -1, dtype=np.int32)
+    reached = np.flatnonzero(np.isfinite(field))
+    if len(reached) == 0:
+        return nearest
+
+    # each node points to the neighbour minimizing distance plus edge length, among lower neighbours
+    rows = graph[reached]
+    counts = np.diff(rows.indptr)
+    row_of = np.repeat(np.arange(len(reached)), counts)
+    reach = field[rows.indices] + rows.data
+    reach[field[rows.indices] >= field[reached[row_of]]] = np.inf
+    best = np.full(len(reached), np.inf)
+    filled = counts > 0
+    best[filled] = np.minimum.reduceat(reach, rows.indptr[:-1][filled])
+    hit = np.flatnonzero(np.isfinite(reach) & (reach == best[row_of]))[::-1]
+
+    parent = np.arange(n, dtype=np.int32)
+    parent[reached[row_of[hit]]] = rows.indices[hit]
+    parent[source_nodes] = source_nodes
+
+    # pointer jumping down to the roots, distances strictly decrease so there are no cycles
+    while True:
+        jumped = parent[parent[reached]]
+        if np.array_equal(jumped, parent[reached]):
+            break
+        parent[reached] = jumped
+    nearest[reached] = parent[reached]
+
+    is_source = np.zeros(n, dtype=bool)
+    is_source[source_nodes] = True
+    stuck = reached[~is_source[nearest[reached]]]
+    if len(stuck):
+        _, _, edge_nearest = csgraph.dijkstra(graph, directed = False, indices = source_nodes, min_only = True,
+                                              return_predecessors = True)
+        nearest[stuck] = np.maximum(edge_nearest[stuck], -1)
+    return nearest
+
+
+def _region_minima(values, sizes):
+    """
+    Minimum of values per region, for values sorted by region with sizes values per region.
+    Regions without values get inf.
+    """
+    minima = np.full(len(sizes), np.inf)
+    filled = sizes > 0
+    if filled.any():
+        starts = np.concatenate([[0], np.cumsum(sizes)[:-1]])
+        minima[filled] = np.minimum.reduceat(values, starts[filled])
+    return minima
+
+
+_summaries = {'min': np.min, 'mean': np.mean, 'median': np.median, 'max': np.max}
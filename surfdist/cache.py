@@ -0,0 +1,122 @@
+import hashlib
+import os
+import tempfile
+
+import numpy as np
+
+
+class DistanceCache(object):
+    """
+    Persistent on-disk cache of distance fields, keyed by a hash of the mesh and the source nodes.
+
+    Fields are stored as compressed .npz files in "directory". Reading a field marks it as recently
+    used, and after every write the least recently used fields are removed until the cache holds at
+    most "max_bytes". Writes go through a temporary file and an atomic rename, so several processes
+    can share one cache directory.
+
+    Inputs
+    -------
+    directory : path of the cache directory, created if it does not exist
+    max_bytes : size limit of the cache in bytes (default 1 GB), None for no limit
+    """
+
+    def __init__(self, directory, max_bytes=2**30):
+        self.directory = os.path.abspath(str(directory))
+        self.max_bytes = max_bytes
+        os.makedirs(self.directory, exist_ok=True)
+
+    def mesh_key(self, mesh):
+        """
+        Hash of the cortex vertices, triangles and cortex indices of a utils.CortexMesh.
+        """
+        return _hash(mesh.vertices, mesh.triangles, mesh.cortex)
+
+    def key(self, mesh_key, source_nodes, **params):
+        """
+        Cache key of the distance field from source_nodes (in cortex indexing) on the mesh with
+        hash mesh_key. Additional solver parameters that change the result go into params.
+        """
+        param_str = repr(sorted(params.items())).encode('utf-8')
+        return _hash(np.asarray(source_nodes, dtype=np.int64), mesh_key.encode('utf-8'), param_str)
+
+    def get(self, key):
+        """
+        Return the cached field for key, or None if it is not in the cache.
+        """
+        filename = self._filename(key)
+        try:
+            with np.load(filename) as cached:
+                data = cached['dist']
+            os.utime(filename)
+        except (FileNotFoundError, KeyError, ValueError, OSError):
+            return None
+        return data
+
+    def put(self, key, data):
+        """
+        Store the field data under key and evict least recently used fields above max_bytes.
+        """
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.savez_compressed(f, dist=data)
+            os.replace(tmp, self._filename(key))
+        except BaseException:
+            os.remove(tmp)
+            raise
+        self.evict()
+
+    def evict(self):
+        """
+        Remove least recently used fields until the cache holds at most max_bytes.
+        """
+        if self.max_bytes is None:
+            return
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.npz'):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def clear(self):
+        """
+        Remove all cached fields.
+        """
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.npz'):
+                os.remove(entry.path)
+
+    def _filename(self, key):
+        return os.path.join(self.directory, key + '.npz')
+
+
+def as_cache(cache):
+    """
+    Return cache as a DistanceCache: None stays None, a path becomes a DistanceCache in that directory.
+    """
+    if cache is None or isinstance(cache, DistanceCache):
+        return cache
+    return DistanceCache(cache)
+
+
+def _hash(*items):
+    digest = hashlib.sha1()
+    for item in items:
+        if isinstance(item, np.ndarray):
+            item = np.ascontiguousarray(item)
+            digest.update(str((item.dtype.str, item.shape)).encode('utf-8'))
+            item = item.data
+        digest.update(item)
+    return digest.hexdigest()
@@ -0,0 +1,169 @@
+import inspect
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import nibabel as nib
+import numpy as np
+
+from surfdist import analysis, load, utils
+
+
+def run_group(subjects_dir, subjects, source, out_file, hemi='lh', template='fsaverage5',
+              annot='aparc.a2009s', label='cortex', surface='pial', n_jobs=1, match_dir=None,
+              **dist_args):
+    """
+    Calculate distances from a source label for many subjects and project them to a template.
+
+    Each subject's distance map is computed with analysis.dist_calc on its native surface, projected
+    to the template with utils.find_node_match on the registered spheres, and written as one float32
+    row of a (n_subjects, n_template_vertices) array memory-mapped from out_file (.npy). Subjects are
+    processed in a pool of n_jobs worker processes and written as soon as they finish.
+
+    Progress is checkpointed per subject in a sidecar file (out_file + '.json'). Calling run_group
+    again with the same arguments resumes a killed run: finished subjects are kept and only the
+    remaining ones are computed. A new array is started if the subjects directory, the subject list
+    or settings changed, including the dist_args that change the distances (e.g. method or max_distance). If a subject
+    fails in the pool, the subjects finished so far are written and checkpointed before the error
+    is raised.
+
+    Inputs
+    -------
+    subjects_dir : FreeSurfer subjects directory, also holding the template subject
+    subjects : list of subject ids
+    source : name of the source label in the annotation (e.g. 'S_central')
+    out_file : path of the .npy output file
+    hemi : hemisphere, 'lh' or 'rh'
+    template : template subject the distances are projected to (e.g. 'fsaverage5')
+    annot : annotation holding the source label (e.g. 'aparc.a2009s')
+    label : label defining the cortex (e.g. 'cortex' for <hemi>.cortex.label)
+    surface : surface the distances are calculated on (e.g. 'pial')
+    n_jobs : number of worker processes, -1 uses all cores
+    match_dir : optional directory caching the native to template node matching per subject
+    dist_args : further keyword arguments of analysis.dist_calc (e.g. cache, method)
+
+    Returns
+    -------
+    numpy memmap of shape (n_subjects, n_template_vertices), rows in the order of subjects
+    """
+
+    subjects = list(subjects)
+    out_file = str(out_file)
+    checkpoint_file = out_file + '.json'
+    settings = dict(subjects_dir=os.path.abspath(subjects_dir), subjects=subjects, source=source, hemi=hemi,
+                    template=template, annot=annot, label=label, surface=surface,
+                    dist_args=_dist_settings(dist_args))
+
+    template_sphere = nib.freesurfer.read_geometry(
+        os.path.join(subjects_dir, template, 'surf', hemi + '.sphere.reg'))[0]
+    shape = (len(subjects), len(template_sphere))
+
+    done = _read_checkpoint(checkpoint_file, settings)
+    if done is not None and os.path.exists(out_file):
+        group = np.lib.format.open_memmap(out_file, mode='r+')
+        if group.shape != shape:
+            done = None
+    else:
+        done = None
+    if done is None:
+        done = []
+        group = np.lib.format.open_memmap(out_file, mode='w+', dtype=np.float32, shape=shape)
+        _write_checkpoint(checkpoint_file, settings, done)
+
+    todo = [s for s in subjects if s not in done]
+    args = dict(subjects_dir=subjects_dir, source=source, hemi=hemi, template=template, annot=annot,
+                label=label, surface=surface, match_dir=match_dir, **dist_args)
+
+    n_jobs = os.cpu_count() if n_jobs is not None and n_jobs < 0 else n_jobs
+    if not n_jobs or n_jobs == 1 or len(todo) <= 1:
+        for subject in todo:
+            group[subjects.index(subject)] = subject_distances(subject=subject, **args)
+            _finish(group, checkpoint_file, settings, done, subject)
+    else:
+        with ProcessPoolExecutor(max_workers=min(n_jobs, len(todo))) as executor:
+            futures = {executor.submit(subject_distances, subject=subject, **args): subject
+                       for subject in todo}
+            error = None
+            for future in as_completed(futures):
+                subject = futures[future]
+                try:
+                    row = future.result()
+                except Exception as e:
+                    # keep collecting the other subjects, so a rerun only repeats the failed ones
+                    error = error or e
+                    continue
+                group[subjects.index(subject)] = row
+                _finish(group, checkpoint_file, settings, done, subject)
+            if error is not None:
+                raise error
+
+    return group
+
+
+def subject_distances(subjects_dir, subject, source, hemi='lh', template='fsaverage5',
+                      annot='aparc.a2009s', label='cortex', surface='pial', match_dir=None,
+                      **dist_args):
+    """
+    Distance from the source label on the native surface of one subject, projected to the template.
+    See run_group for the arguments. Returns a float32 array of length n_template_vertices.
+    """
+
+    subject_dir = os.path.join(subjects_dir, subject)
+    surf = nib.freesurfer.read_geometry(os.path.join(subject_dir, 'surf', hemi + '.' + surface))
+    cort = np.sort(nib.freesurfer.read_label(os.path.join(subject_dir, 'label', hemi + '.' + label + '.label')))
+    src = load.load_freesurfer_label(os.path.join(subject_dir, 'label', hemi + '.' + annot + '.annot'), source)
+
+    dist = analysis.dist_calc(surf, cort, src, **dist_args)
+
+    trg = nib.freesurfer.read_geometry(os.path.join(subjects_dir, template, 'surf', hemi + '.sphere.reg'))[0]
+    native = nib.freesurfer.read_geometry(os.path.join(subject_dir, 'surf', hemi + '.sphere.reg'))[0]
+    cache_file = None
+    if match_dir is not None:
+        os.makedirs(match_dir, exist_ok=True)
+        cache_file = os.path.join(match_dir, '%s_%s_%s.npz' % (subject, hemi, template))
+    idx_trg_to_native = utils.find_node_match(trg, native, cache_file=cache_file)[0]
+
+    return dist[idx_trg_to_native].astype(np.float32)
+
+
+def _dist_settings(dist_args):
+    # the dist_calc arguments that change the distances, with defaults filled in, as JSON values
+    defaults = {name: parameter.default for name, parameter in
+                inspect.signature(analysis.dist_calc).parameters.items()
+                if parameter.default is not inspect.Parameter.empty}
+    settings = {}
+    for name, value in sorted(dict(defaults, **dist_args).items()):
+        if name in ('cache', 'out'):
+            continue
+        if name == 'dtype':
+            value = np.dtype(value).str
+        elif isinstance(value, np.generic):
+            # e.g. max_distance=np.float32(20), which json cannot write
+            value = value.item()
+        settings[name] = value
+    return settings
+
+
+def _finish(group, checkpoint_file, settings, done, subject):
+    # the row is on disk before the subject is marked as done
+    group.flush()
+    done.append(subject)
+    _write_checkpoint(checkpoint_file, settings, done)
+
+
+def _read_checkpoint(checkpoint_file, settings):
+    try:
+        with open(checkpoint_file) as f:
+            checkpoint = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+    if checkpoint.get('settings') != settings:
+        return None
+    return checkpoint['done']
+
+
+def _write_checkpoint(checkpoint_file, settings, done):
+    tmp = checkpoint_file + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(dict(settings=settings, done=done), f)
+    os.replace(tmp, checkpoint_file)
@@ -0,0 +1,125 @@
+import collections
+import contextlib
+import logging
+import time
+import tracemalloc
+
+logger = logging.getLogger(__name__)
+
+# one record per finished stage
+StageRecord = collections.namedtuple('StageRecord', ['stage', 'wall_time', 'cpu_time', 'peak_bytes', 'info'])
+StageRecord.__doc__ = """
+Timing of one stage of a calculation.
+
+wall_time and cpu_time are in seconds; cpu_time is the CPU time of the whole process. peak_bytes is
+the peak of memory allocated through Python (including numpy arrays) above the level at the start
+of the stage, or None if memory was not traced (always on Python < 3.9, which cannot reset the
+traced peak). info holds details such as the region of a solve.
+"""
+
+# active recorders, stages are not timed at all while this is empty
+_recorders = []
+# restarts the traced peak per stage, Python >= 3.9
+_reset_peak = getattr(tracemalloc, 'reset_peak', None)
+# enclosing stages being timed, as [start current memory, peak memory so far]
+_open = []
+
+
+@contextlib.contextmanager
+def record(callback=None, memory=True):
+    """
+    Record the stages of the surfdist calculations run inside the with block.
+
+    Stages are 'surf_keep_cortex' (building the cortex mesh), 'read_annotation', 'translate_src',
+    'solve' (one distance field), 'summary' (reducing a field to the regions or zones) and 'recort'.
+    Stages of dist_calc_matrix and zone_calc that run in worker processes (n_jobs > 1) are not
+    recorded individually, the enclosing 'solves' stage covers them.
+
+    Inputs
+    -------
+    callback : optional function called with every StageRecord as soon as its stage finishes,
+               e.g. log to send the records to the 'surfdist.instrument' logger
+    memory : trace peak memory with tracemalloc, which slows down allocations; False only times.
+             Peak memory needs Python 3.9 or later, on older versions only times are recorded.
+
+    Returns
+    -------
+    list the StageRecords are appended to, in order of completion (nested stages come first)
+
+    Example
+    -------
+    with instrument.record(instrument.log) as records:
+        analysis.dist_calc_matrix(surf, cortex, annot)
+    """
+    memory = memory and _reset_peak is not None
+    started = memory and not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start()
+    recorder = ([], callback, memory)
+    _recorders.append(recorder)
+    try:
+        yield recorder[0]
+    finally:
+        _recorders.remove(recorder)
+        if started:
+            tracemalloc.stop()
+
+
+def stage(name, **info):
+    """
+    Context manager timing one stage for the active recorders, see record. Costs one check of
+    the recorder list when nothing is recorded.
+    """
+    if not _recorders:
+        return _disabled
+    return _timed(name, info)
+
+
+def log(stage_record):
+    """
+    Callback of record emitting a StageRecord as a debug message of the 'surfdist.instrument'
+    logger, with its fields as attributes of the log record.
+    """
+    logger.debug('%s: %.3f s wall, %.3f s cpu, %s bytes peak', stage_record.stage, stage_record.wall_time,
+                 stage_record.cpu_time, stage_record.peak_bytes, extra=dict(stage_record._asdict()))
+
+
+_disabled = contextlib.nullcontext()
+
+
+def _detach():
+    # stop recording in a forked process
+    del _recorders[:]
+    del _open[:]
+    if tracemalloc.is_tracing():
+        tracemalloc.stop()
+
+
+@contextlib.contextmanager
+def _timed(name, info):
+    tracing = _reset_peak is not None and tracemalloc.is_tracing()
+    if tracing:
+        current, peak = tracemalloc.get_traced_memory()
+        # the peak so far belongs to the enclosing stage, then restart it for this one
+        if _open:
+            _open[-1][1] = max(_open[-1][1], peak)
+        _reset_peak()
+        _open.append([current, current])
+    wall, cpu = time.perf_counter(), time.process_time()
+    try:
+        yield
+    finally:
+        wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+        peak_bytes = None
+        if tracing:
+            start, peak = _open.pop()
+            peak = max(peak, tracemalloc.get_traced_memory()[1])
+            if _open:
+                _open[-1][1] = max(_open[-1][1], peak)
+            peak_bytes = peak - start
+        stage_record = StageRecord(name, wall, cpu, peak_bytes, info)
+        for records, callback, memory in list(_recorders):
+            recorded = stage_record if memory else stage_record._replace(peak_bytes=None)
+            records.append(recorded)
+            if callback is not None:
+                callback(recorded)
@@ -1,7 +1,71 @@
+import functools
+import os
+
 import nibabel as nib
 import numpy as np
 
 
+class Annotation(object):
+    """
+    Freesurfer annotation parsed once, serving the nodes of any label as a zero-copy slice.
+
+    The nodes are stored sorted by label value (CSR style): the nodes of the label with index i
+    are order[offsets[i]:offsets[i+1]], in increasing node order. Use read_annotation to share
+    one parsed annotation per file.
+
+    Attributes
+    -------
+    labels : label value of each node (-1 for nodes without label)
+    color_table : color table of the annotation
+    names : label names as read from the file (bytes)
+    label_names : label names as str
+    order : int32 node indices sorted by label value (read-only)
+    offsets : start of each label in order, followed by the total number of labelled nodes
+    """
+
+    def __init__(self, annot_input):
+        self.labels, self.color_table, self.names = nib.freesurfer.read_annot(annot_input)
+        self.label_names = [i.decode('utf-8') for i in self.names]
+
+        # nodes without label (-1) sort first and are skipped by the offsets
+        order = np.argsort(self.labels, kind='stable').astype(np.int32)
+        labelled = self.labels[order] >= 0
+        counts = np.bincount(self.labels[order[labelled]], minlength=len(self.names))
+        self.offsets = np.concatenate([[0], np.cumsum(counts)]) + np.count_nonzero(~labelled)
+        self.order = order
+        self.order.setflags(write=False)
+
+    def index(self, label_name):
+        """
+        Index (label value) of a label given by name (str or bytes).
+        """
+        if isinstance(label_name, bytes):
+            label_name = label_name.decode('utf-8')
+        return self.label_names.index(label_name)
+
+    def label_nodes(self, label):
+        """
+        Read-only view of the nodes of a label, given by name or index.
+        """
+        if not isinstance(label, (int, np.integer)):
+            label = self.index(label)
+        return self.order[self.offsets[label]:self.offsets[label + 1]]
+
+
+def read_annotation(annot_input):
+    """
+    Return the Annotation of a file, parsed only once as long as the file is not modified.
+    """
+    annot_input = os.path.abspath(str(annot_input))
+    stat = os.stat(annot_input)
+    return _read_annotation(annot_input, stat.st_mtime_ns, stat.st_size)
+
+
+@functools.lru_cache(maxsize=32)
+def _read_annotation(annot_input, mtime, size):
+    return Annotation(annot_input)
+
+
 def load_freesurfer_label(annot_input, label_name, cortex=None):
     """
     Get source node list for a specified freesurfer label.
@@ -11,26 +75,111 @@ def load_freesurfer_label(annot_input, label_name, cortex=None):
     annot_input : freesurfer annotation label file
     label_name : freesurfer label name
     cortex : not used
+
+    The annotation is parsed once per file (see read_annotation); the returned
+    array of shape (1, n_nodes) is a read-only view into it.
     """
 
     if cortex is not None:
         print("Warning: cortex is not used to load the freesurfer label")
 
-    labels, color_table, names = nib.freesurfer.read_annot(annot_input)
-    names = [i.decode('utf-8') for i in names]
-    if isinstance(label_name, bytes):
-        label_name = label_name.decode('utf-8')
-    label_value = names.index(label_name)
-    label_nodes = np.array(np.where(np.in1d(labels, label_value)), dtype=np.int32)
+    label_nodes = read_annotation(annot_input).label_nodes(label_name)
 
-    return label_nodes
+    return label_nodes.reshape(1, -1)
 
 
 def get_freesurfer_label(annot_input, verbose = True):
     """
     Print freesurfer label names.
     """
-    labels, color_table, names = nib.freesurfer.read_annot(annot_input)
+    # a copy, the names of the cached annotation are shared by all calls
+    names = list(read_annotation(annot_input).names)
     if verbose:
         print(names)
     return names
+
+
+dist_formats = {'csv': '.csv', 'npy': '.npy', 'hdf5': '.h5', 'gifti': '.func.gii'}
+
+
+def save_dist(data, basename, out_format='csv'):
+    """
+    Write distance values to basename plus the extension of out_format and return the file name.
+
+    Inputs
+    -------
+    data : array of shape (n_nodes,), or (n_subjects, n_nodes) for stacked distances
+    basename : output path without extension
+    out_format : 'csv' (comma-separated text, e.g. for PALM), 'npy', 'hdf5' (requires h5py; one
+                 chunk per row, dataset 'distances') or 'gifti' (.func.gii, one data array per row)
+    """
+    if out_format not in dist_formats:
+        raise ValueError(f'undefined output format: {out_format}')
+    filename = basename + dist_formats[out_format]
+
+    if out_format == 'csv':
+        data.tofile(filename, sep=",")
+    elif out_format == 'npy':
+        np.save(filename, data)
+    elif out_format == 'hdf5':
+        import h5py
+        with h5py.File(filename, 'w') as f:
+            f.create_dataset('distances', data=data, chunks=(1,) * (data.ndim - 1) + data.shape[-1:])
+    else:
+        rows = np.atleast_2d(data).astype(np.float32)
+        img = nib.gifti.GiftiImage(darrays=[nib.gifti.GiftiDataArray(row, intent='NIFTI_INTENT_SHAPE',
+                                                                      datatype='NIFTI_TYPE_FLOAT32')
+                                            for row in rows])
+        nib.save(img, filename)
+
+    return filename
+
+
+def load_dist(filename, mmap_mode=None):
+    """
+    Read distance values written by save_dist, the format is taken from the file extension.
+    mmap_mode is passed to np.load for .npy files.
+    """
+    if filename.endswith(dist_formats['csv']):
+        return np.genfromtxt(filename, delimiter=',')
+    if filename.endswith(dist_formats['npy']):
+        return np.load(filename, mmap_mode=mmap_mode)
+    if filename.endswith(dist_formats['hdf5']):
+        import h5py
+        with h5py.File(filename, 'r') as f:
+            return f['distances'][()]
+    if filename.endswith('.gii'):
+        darrays = nib.load(filename).darrays
+        data = np.array([d.data for d in darrays])
+        return data[0] if len(darrays) == 1 else data
+    raise ValueError(f'unknown distance file format: {filename}')
+
+
+def stack_dist(files, basename, out_format='csv'):
+    """
+    Stack the distances of several files (e.g. one per subject) into one (n_files, n_nodes) file
+    written in out_format (see save_dist), and return its file name.
+    npy and hdf5 output is written row by row, so only one input is held in memory at a time.
+    """
+    if out_format not in dist_formats:
+        raise ValueError(f'undefined output format: {out_format}')
+    if out_format in ('csv', 'gifti'):
+        return save_dist(np.array([load_dist(f) for f in files]), basename, out_format)
+
+    filename = basename + dist_formats[out_format]
+    first = np.ravel(load_dist(files[0], mmap_mode='r'))
+    shape = (len(files), len(first))
+    if out_format == 'npy':
+        stacked = np.lib.format.open_memmap(filename, mode='w+', dtype=first.dtype, shape=shape)
+        for i, f in enumerate(files):
+            stacked[i] = np.ravel(load_dist(f, mmap_mode='r'))
+        stacked.flush()
+        del stacked
+    else:
+        import h5py
+        with h5py.File(filename, 'w') as h5:
+            stacked = h5.create_dataset('distances', shape=shape, dtype=first.dtype, chunks=(1, shape[1]))
+            for i, f in enumerate(files):
+                stacked[i] = np.ravel(load_dist(f))
+
+    return filename
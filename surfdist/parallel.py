@@ -0,0 +1,92 @@
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from surfdist import instrument
+
+# mesh and task function of a worker process, set once by _init_worker
+_worker = {}
+
+
+def map_sources(func, vertices, triangles, sources, n_jobs=1):
+    """
+    Apply func(vertices, triangles, source) to each entry of sources and yield the results in order.
+
+    Inputs
+    -------
+    func : picklable function taking the mesh vertices, triangles and one source entry
+           (e.g. an array of source nodes), typically running one geodesic solve.
+    vertices, triangles : mesh arrays (e.g. the output from surf_keep_cortex)
+    sources : sequence of source entries, one task per entry
+    n_jobs : number of worker processes. 1 runs serially in the calling process,
+             -1 uses all available cores.
+
+    With n_jobs > 1 the mesh is placed in shared memory once and every worker attaches
+    to it, so only the source entries are sent per task. func itself is sent once per
+    worker. At most two tasks per worker are in flight, so results of finished tasks do
+    not pile up while the caller consumes them.
+    """
+
+    n_jobs = _n_workers(n_jobs, len(sources))
+
+    if n_jobs == 1:
+        for source in sources:
+            yield func(vertices, triangles, source)
+        return
+
+    blocks = [_share(vertices), _share(triangles)]
+    try:
+        specs = [(shm.name, arr.shape, arr.dtype.str) for shm, arr in blocks]
+        with ProcessPoolExecutor(max_workers=n_jobs, initializer=_init_worker,
+                                 initargs=(specs, func)) as executor:
+            pending = deque()
+            tasks = iter(sources)
+            try:
+                for source in tasks:
+                    pending.append(executor.submit(_run_worker, source))
+                    if len(pending) >= 2 * n_jobs:
+                        break
+                while pending:
+                    result = pending.popleft().result()
+                    for source in tasks:
+                        pending.append(executor.submit(_run_worker, source))
+                        break
+                    yield result
+            finally:
+                for future in pending:
+                    future.cancel()
+    finally:
+        for shm, _ in blocks:
+            shm.close()
+            shm.unlink()
+
+
+def _n_workers(n_jobs, n_tasks):
+    if n_jobs is None:
+        n_jobs = 1
+    if n_jobs < 0:
+        n_jobs = max(os.cpu_count() + 1 + n_jobs, 1)
+    return max(min(n_jobs, n_tasks), 1)
+
+
+def _share(arr):
+    arr = np.ascontiguousarray(arr)
+    shm = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+    np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)[...] = arr
+    return shm, arr
+
+
+def _init_worker(specs, func):
+    # forked workers inherit the recorders of the parent, their stages are not recorded
+    instrument._detach()
+    blocks = [shared_memory.SharedMemory(name=name) for name, _, _ in specs]
+    vertices, triangles = [np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+                           for shm, (_, shape, dtype) in zip(blocks, specs)]
+    _worker.update(blocks=blocks, vertices=vertices, triangles=triangles, func=func)
+
+
+def _run_worker(source):
+    return _worker['func'](_worker['vertices'], _worker['triangles'], source)
@@ -1,119 +1,97 @@
+import numpy as np
+import scipy.sparse
+from scipy.sparse import csgraph
+from surfdist.utils import find_node_match
+
+
 
 def find_idx_match(simple_vertices, complex_vertices):
     '''
-    Thanks to juhuntenburg. 
+    Thanks to juhuntenburg.
     Functions taken from https://github.com/juhuntenburg/brainsurfacescripts
 
     Finds those points on the complex mesh that correspoind best to the
-    simple mesh while forcing a one-to-one mapping
+    simple mesh while forcing a one-to-one mapping, see utils.find_node_match.
     '''
-    # make array for writing in final voronoi seed indices
-    voronoi_seed_idx = np.zeros((simple_vertices.shape[0],), dtype='int64')-1
-    missing = np.where(voronoi_seed_idx == -1)[0].shape[0]
-    mapping_single = np.zeros_like(voronoi_seed_idx)
-
-    neighbours = 0
-    col = 0
-
-    while missing != 0:
-
-        neighbours += 100
-        # find nearest neighbours
-        inaccuracy, mapping = spatial.KDTree(
-            complex_vertices).query(simple_vertices, k=neighbours)
-        # go through columns of nearest neighbours until unique mapping is
-        # achieved, if not before end of neighbours, extend number of
-        # neighbours
-        while col < neighbours:
-            # find all missing voronoi seed indices
-            missing_idx = np.where(voronoi_seed_idx == -1)[0]
-            missing = missing_idx.shape[0]
-            if missing == 0:
-                break
-            else:
-                # for missing entries fill in next neighbour
-                mapping_single[missing_idx] = np.copy(
-                    mapping[missing_idx, col])
-                # find unique values in mapping_single
-                unique, double_idx = np.unique(
-                    mapping_single, return_inverse=True)
-                # empty voronoi seed index
-                voronoi_seed_idx = np.zeros(
-                    (simple_vertices.shape[0],), dtype='int64')-1
-                # fill voronoi seed idx with unique values
-                for u in range(unique.shape[0]):
-                    # find the indices of this value in mapping
-                    entries = np.where(double_idx == u)[0]
-                    # set the first entry to the value
-                    voronoi_seed_idx[entries[0]] = unique[u]
-                # go to next column
-                col += 1
-
-    return voronoi_seed_idx, inaccuracy
+    return find_node_match(simple_vertices, complex_vertices)
 
 
 def competetive_fast_marching(vertices, graph, seeds):
     '''
-    Label all vertices on highres mesh to the closest seed vertex
-    using a balanced binary search tree
+    Label all vertices on highres mesh to the closest seed vertex.
+
+    graph is the sparse edge graph of the highres mesh (see utils.surf_graph),
+    seeds the highres indices of the seed vertices (e.g. from find_idx_match).
+    Runs a single multi-source Dijkstra over the edge graph, so each vertex is
+    reached by the front of the seed with the shortest path along the edges.
+    Returns an array of shape (n_vertices, 2): the first column holds the vertex
+    indices, the second the position in seeds of the closest seed (-1 for
+    vertices not connected to any seed).
     '''
-    # make a labelling container to be filled with the search tree
+    seeds = np.asarray(seeds)
     # first column are the vertex indices of the complex mesh
     # second column are the labels from the simple mesh
-    # (-1 for all but the corresponding points for now)
     labels = np.zeros((vertices.shape[0], 2), dtype='int64')-1
     labels[:, 0] = range(vertices.shape[0])
-    for i in range(seeds.shape[0]):
-        labels[seeds[i]][1] = i
-    # initiate AVLTree for binary search
-    tree = FastAVLTree()
-    # organisation of the tree will be
-    # key: edge length; value: tuple of vertices (source, target)
-    # add all neighbours of the voronoi seeds
-    for v in seeds:
-        add_neighbours(v, 0, graph, labels, tree)
-    # Competetive fast marching starting from voronoi seeds
-    while tree.count > 0:
-
-        # pdb.set_trace()
-        # pop the item with minimum edge length
-        min_item = tree.pop_min()
-        length = min_item[0]
-        source = min_item[1][0]
-        target = min_item[1][1]
-        # if target no label yet (but source does!), assign label of source
-        if labels[target][1] == -1:
-            if labels[source][1] == -1:
-                sys.exit('Source has no label, something went wrong!')
-            else:
-                # assign label of source to target
-                labels[target][1] = labels[source][1]
-
-        # test if labelling is complete
-        if any(labels[:, 1] == -1):
-            # if not, add neighbours of target to tree
-            add_neighbours(target, length, graph, labels, tree)
-        else:
-            break
-
-        # print 'tree '+str(tree.count)
-        # print 'labels '+str(np.where(labels[:,1]==-1)[0].shape[0])
+
+    # position of each seed in seeds, looked up from the seed vertex index
+    seed_label = np.zeros(vertices.shape[0], dtype='int64')-1
+    seed_label[seeds] = np.arange(seeds.shape[0])
+
+    _, _, closest_seed = csgraph.dijkstra(graph, directed=False, indices=seeds,
+                                          return_predecessors=True, min_only=True)
+    reached = closest_seed >= 0
+    labels[reached, 1] = seed_label[closest_seed[reached]]
 
     return labels
 
 
+def averaging_matrix(labels, n_labels=None):
+    '''
+    Build the sparse matrix that averages highres data over vertices with the
+    same label.
+
+    labels holds the label (typically the simple mesh vertex) of each highres
+    vertex, e.g. the second column of competetive_fast_marching; vertices
+    labelled -1 are ignored. Returns a scipy.sparse.csr_matrix of shape
+    (n_labels, n_highres_vertices) whose rows sum to one, or to zero for
+    labels without vertices. The matrix only depends on the labelling, so it
+    can be built once per mesh pair and passed to sample_simple for many data
+    arrays.
+    '''
+    labels = np.asarray(labels)
+    if labels.ndim == 2:
+        labels = labels[:, 1]
+    if n_labels is None:
+        n_labels = int(labels.max()+1)
+
+    n_vertices = labels.shape[0]
+    vertices = np.where(labels >= 0)[0]
+    labels = labels[vertices]
+    counts = np.bincount(labels, minlength=n_labels)
+    weights = 1. / counts[labels]
+
+    return scipy.sparse.csr_matrix((weights, (labels, vertices)),
+                                   shape=(n_labels, n_vertices))
+
+
 def sample_simple(highres_data, labels):
     '''
     Computes the mean of data from highres mesh that is assigned to the same
     label (typical simple mesh vertices).
+
+    highres_data is an array of shape (n_highres_vertices,) or
+    (n_highres_vertices, n_columns), e.g. a time series, which is averaged in
+    a single sparse product. labels is either the label array (see
+    averaging_matrix) or a matrix returned by averaging_matrix, which can be
+    reused across data arrays. Labels without any vertices are set to nan.
     '''
-    # create new empty lowres data array
-    lowres_data = np.empty((int(labels.max()+1), highres_data.shape[1]))
-    # find all vertices on highres and mean
-    for l in range(int(labels.max())):
-        patch = np.where(labels == l)[0]
-        patch_data = highres_data[patch]
-        patch_mean = np.mean(patch_data, axis=0)
-        lowres_data[l] = patch_mean
+    if scipy.sparse.issparse(labels):
+        averaging = labels
+    else:
+        averaging = averaging_matrix(labels)
+
+    lowres_data = averaging @ highres_data
+    lowres_data[averaging.getnnz(axis=1) == 0] = np.nan
 
     return lowres_data
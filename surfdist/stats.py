@@ -0,0 +1,251 @@
+import numpy as np
+import scipy.stats
+
+
+class RunningStats(object):
+    """
+    Per-vertex count, mean and variance of distance maps added one subject (or batch) at a time.
+
+    Uses Welford's online update, merged per batch with the pairwise formula of Chan et al., so the
+    memory does not grow with the number of subjects and partial results of parallel workers can
+    be combined with merge. Values that are not finite (e.g. inf beyond max_distance, nan) are left
+    out for that vertex only.
+
+    Inputs
+    -------
+    n_vertices : number of vertices of the maps, e.g. of the template they are projected to
+
+    Attributes
+    -------
+    count : number of values per vertex
+    mean : mean per vertex (0 where count is 0)
+    m2 : sum of squared deviations from the mean per vertex
+    """
+
+    def __init__(self, n_vertices):
+        self.count = np.zeros(n_vertices, dtype=np.int64)
+        self.mean = np.zeros(n_vertices)
+        self.m2 = np.zeros(n_vertices)
+
+    def add(self, values):
+        """
+        Add the map of one subject, array of shape (n_vertices,), or of several subjects,
+        array of shape (n_subjects, n_vertices). Returns self.
+        """
+        values = np.atleast_2d(np.asarray(values, dtype=np.float64))
+        finite = np.isfinite(values)
+        if finite.all():
+            count = np.full(values.shape[1], len(values), dtype=np.int64)
+            mean = values.mean(axis=0)
+            m2 = ((values - mean) ** 2).sum(axis=0)
+        else:
+            values = np.where(finite, values, 0.)
+            count = finite.sum(axis=0)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                mean = np.where(count > 0, values.sum(axis=0) / count, 0.)
+            m2 = (np.where(finite, values - mean, 0.) ** 2).sum(axis=0)
+        self._merge(count, mean, m2)
+        return self
+
+    def merge(self, other):
+        """
+        Add the values accumulated by another RunningStats on the same vertices. Returns self.
+        """
+        if other.count.shape != self.count.shape:
+            raise ValueError('cannot merge statistics of %d and %d vertices' % (len(self.count), len(other.count)))
+        self._merge(other.count, other.mean, other.m2)
+        return self
+
+    def _merge(self, count, mean, m2):
+        total = self.count + count
+        delta = mean - self.mean
+        with np.errstate(invalid='ignore', divide='ignore'):
+            weight = np.where(total > 0, count / total, 0.)
+        self.mean += delta * weight
+        self.m2 += m2 + delta ** 2 * self.count * weight
+        self.count = total
+
+    @property
+    def variance(self):
+        """
+        Unbiased variance per vertex (ddof=1), nan where fewer than two values were added.
+        """
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(self.count > 1, self.m2 / (self.count - 1), np.nan)
+
+    @property
+    def std(self):
+        return np.sqrt(self.variance)
+
+    def save(self, filename):
+        """
+        Write the accumulator to an .npz file, e.g. to merge the results of separate jobs.
+        """
+        np.savez(filename, count=self.count, mean=self.mean, m2=self.m2)
+
+    @classmethod
+    def load(cls, filename):
+        with np.load(filename) as data:
+            stats = cls(len(data['count']))
+            stats.count, stats.mean, stats.m2 = data['count'], data['mean'], data['m2']
+        return stats
+
+
+class QuantileSketch(object):
+    """
+    Per-vertex histogram of distance maps with fixed bins, for approximate quantiles.
+
+    Every vertex has n_bins equal bins between low and high. Values below low (including -inf)
+    and above high (including inf, e.g. beyond max_distance) are counted separately as underflow
+    and overflow, and quantiles whose rank falls among them are -inf or inf. Histograms with the
+    same bins are merged by adding the counts, so sketches of parallel workers can be combined with
+    merge. Within [low, high] a quantile is accurate to one bin width, (high - low) / n_bins. nan
+    values are left out. Memory is n_vertices x n_bins counts, independent of the number of subjects.
+
+    Inputs
+    -------
+    n_vertices : number of vertices of the maps
+    low, high : range of the bins, e.g. 0 and the largest expected distance in mm
+    n_bins : number of bins per vertex
+    dtype : integer dtype of the counts, uint32 holds up to about 4e9 subjects
+
+    Attributes
+    -------
+    edges : bin edges, array of length n_bins + 1
+    counts : counts per vertex and bin, array of shape (n_vertices, n_bins)
+    underflow, overflow : counts per vertex of the values below low and above high
+    """
+
+    def __init__(self, n_vertices, low, high, n_bins=256, dtype=np.uint32):
+        if not high > low:
+            raise ValueError('high must be larger than low')
+        self.edges = np.linspace(low, high, n_bins + 1)
+        self.counts = np.zeros((n_vertices, n_bins), dtype=dtype)
+        self.underflow = np.zeros(n_vertices, dtype=dtype)
+        self.overflow = np.zeros(n_vertices, dtype=dtype)
+
+    def add(self, values):
+        """
+        Add the map of one subject, array of shape (n_vertices,), or of several subjects,
+        array of shape (n_subjects, n_vertices). Returns self.
+        """
+        values = np.atleast_2d(np.asarray(values, dtype=np.float64))
+        n_bins = self.counts.shape[1]
+        vertices = np.arange(self.counts.shape[0])
+        low, high = self.edges[0], self.edges[-1]
+        width = self.edges[1] - low
+        for row in values:
+            # nan is in none of them
+            below, above = row < low, row > high
+            inside = (row >= low) & (row <= high)
+            self.underflow += below
+            self.overflow += above
+            # high itself goes into the last bin
+            bins = np.minimum(((row[inside] - low) / width).astype(np.int64), n_bins - 1)
+            # every vertex gets at most one value per row, so the indices are unique
+            self.counts[vertices[inside], bins] += 1
+        return self
+
+    def merge(self, other):
+        """
+        Add the counts of another QuantileSketch with the same vertices and bins. Returns self.
+        """
+        if other.counts.shape != self.counts.shape or not np.array_equal(other.edges, self.edges):
+            raise ValueError('cannot merge sketches with different vertices or bins')
+        self.counts += other.counts
+        self.underflow += other.underflow
+        self.overflow += other.overflow
+        return self
+
+    def quantile(self, q):
+        """
+        Approximate q-th quantile per vertex, q in [0, 1] (scalar or sequence), interpolated
+        linearly within the bins. Returns an array of shape (n_vertices,), or (len(q), n_vertices)
+        for a sequence; -inf or inf where the rank falls among the values below low or above high,
+        nan where no values were added.
+        """
+        qs = np.atleast_1d(np.asarray(q, dtype=np.float64))
+        # underflow and overflow as bins of their own at both ends
+        counts = np.hstack([self.underflow[:, None], self.counts, self.overflow[:, None]])
+        cumulative = np.cumsum(counts, axis=1, dtype=np.int64)
+        total = cumulative[:, -1]
+        n_bins = self.counts.shape[1]
+        width = self.edges[1] - self.edges[0]
+        result = np.full((len(qs), len(total)), np.nan)
+        filled = total > 0
+        vertices = np.flatnonzero(filled)
+        for i, quantile in enumerate(qs):
+            rank = quantile * total[filled]
+            # first bin holding the value of this rank, and the part of its count below the rank
+            bins = np.argmax(cumulative[filled] >= np.maximum(rank, 1e-12)[:, None], axis=1)
+            below = np.where(bins > 0, cumulative[vertices, bins - 1], 0)
+            fraction = (rank - below) / counts[vertices, bins]
+            values = self.edges[np.clip(bins - 1, 0, n_bins)] + np.clip(fraction, 0., 1.) * width
+            values[bins == 0] = -np.inf
+            values[bins == n_bins + 1] = np.inf
+            result[i, filled] = values
+        return result[0] if np.ndim(q) == 0 else result
+
+    def median(self):
+        return self.quantile(.5)
+
+    def save(self, filename):
+        """
+        Write the sketch to an .npz file, e.g. to merge the results of separate jobs.
+        """
+        np.savez(filename, edges=self.edges, counts=self.counts, underflow=self.underflow,
+                 overflow=self.overflow)
+
+    @classmethod
+    def load(cls, filename):
+        with np.load(filename) as data:
+            edges, counts = data['edges'], data['counts']
+            underflow, overflow = data['underflow'], data['overflow']
+        sketch = cls(counts.shape[0], edges[0], edges[-1], n_bins=counts.shape[1], dtype=counts.dtype)
+        sketch.edges, sketch.counts = edges, counts
+        sketch.underflow, sketch.overflow = underflow, overflow
+        return sketch
+
+
+def accumulate(maps, low=None, high=None, n_bins=256):
+    """
+    Consume distance maps one at a time, e.g. rows of the memmap of group.run_group or files read
+    with load.load_dist, into a RunningStats and, if low and high are given, a QuantileSketch.
+    Returns the RunningStats, or (RunningStats, QuantileSketch).
+    """
+    stats = sketch = None
+    for values in maps:
+        if stats is None:
+            n_vertices = np.shape(values)[-1]
+            stats = RunningStats(n_vertices)
+            if low is not None and high is not None:
+                sketch = QuantileSketch(n_vertices, low, high, n_bins=n_bins)
+        stats.add(values)
+        if sketch is not None:
+            sketch.add(values)
+    if stats is None:
+        raise ValueError('no maps to accumulate')
+    if low is not None and high is not None:
+        return stats, sketch
+    return stats
+
+
+def welch_t(a, b):
+    """
+    Welch's t-test per vertex between two groups, from their RunningStats.
+
+    Returns
+    -------
+    t : t statistic of mean(a) - mean(b) per vertex
+    df : Welch-Satterthwaite degrees of freedom per vertex
+    p : two-sided p-value per vertex (uncorrected for the number of vertices)
+    Vertices with fewer than two values in either group get nan.
+    """
+    with np.errstate(invalid='ignore', divide='ignore'):
+        se_a = a.variance / a.count
+        se_b = b.variance / b.count
+        se = se_a + se_b
+        t = (a.mean - b.mean) / np.sqrt(se)
+        df = se ** 2 / (se_a ** 2 / (a.count - 1) + se_b ** 2 / (b.count - 1))
+    p = 2 * scipy.stats.t.sf(np.abs(t), df)
+    return t, df, p
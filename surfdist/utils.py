@@ -50,65 +50,209 @@ def translate_src(src, cortex):
 
     return src_new
 
-def recort(input_data, surf, cortex):
+def recort(input_data, surf, cortex, dtype=np.float64, out=None):
     """
     Return data values to space of full cortex (including medial wall), with medial wall equal to zero.
+    The result has the given dtype, or is written into out (e.g. a row of a float32 np.memmap) if given.
     """
-    data = np.zeros(len(surf[0]))
+    return _scatter(input_data, len(surf[0]), cortex, dtype, out)
+
+
+def _scatter(input_data, n_nodes, cortex, dtype, out):
+    if out is None:
+        data = np.zeros(n_nodes, dtype=dtype)
+    else:
+        if out.shape != (n_nodes,):
+            raise ValueError('out must have shape (%d,), got %s' % (n_nodes, out.shape))
+        data = out
+        data[...] = 0
     data[cortex] = input_data
     return data
 
-def find_node_match(simple_vertices, complex_vertices):
+class CortexMesh(object):
+    """
+    Cortical surface mesh with the medial wall removed, built once and reused across calls.
+
+    Holds the output of surf_keep_cortex together with the index maps used by translate_src
+    and recort, so that repeated analyses on the same subject skip the mesh preparation. All
+    functions in surfdist.analysis accept a CortexMesh in place of surf, with cortex set to None.
+
+    Inputs
+    -------
+    surf : Tuple containing two numpy arrays of shape (n_nodes,3), vertices and triangles of the full
+           surface mesh (e.g. the output from nibabel.freesurfer.io.read_geometry)
+    cortex : Sorted array with indices of vertices included in within the cortex.
+             (e.g. the output from nibabel.freesurfer.io.read_label)
+
+    Attributes
+    -------
+    vertices, triangles : mesh without medial wall, as returned by surf_keep_cortex
+    cortex : indices of the cortex vertices in the full mesh, used to scatter data back by recort
+    index : array of length n_nodes mapping full mesh indices to cortex mesh indices, -1 outside cortex
+    n_nodes : number of vertices of the full mesh
+    graph : edge graph of the mesh without medial wall (see surf_graph), built on first use
+    """
+
+    def __init__(self, surf, cortex):
+        vertices, triangles = surf
+        self.n_nodes = len(vertices)
+        self.cortex = np.asarray(cortex, dtype=np.intp)
+
+        self.index = np.full(self.n_nodes, -1, dtype=np.int32)
+        self.index[self.cortex] = np.arange(len(self.cortex), dtype=np.int32)
+
+        # keep only the vertices within the cortex label
+        self.vertices = np.array(vertices[self.cortex], dtype=np.float64)
+
+        # keep only the triangles with all nodes within the cortex label, in new node indices
+        new_triangles = self.index[triangles]
+        self.triangles = np.ascontiguousarray(new_triangles[np.all(new_triangles >= 0, axis=1)])
+        self._graph = None
+
+    @property
+    def graph(self):
+        if self._graph is None:
+            self._graph = surf_graph(self.vertices, self.triangles)
+        return self._graph
+
+    def translate(self, src):
+        """
+        Convert source nodes to the surface without medial wall, same as translate_src.
+        """
+        src_new = self.index[np.asarray(src).ravel()]
+        return np.unique(src_new[src_new >= 0]).astype(np.int32)
+
+    def recort(self, input_data, dtype=np.float64, out=None):
+        """
+        Return data values to space of full cortex (including medial wall), same as recort.
+        """
+        return _scatter(input_data, self.n_nodes, self.cortex, dtype, out)
+
+    def recort_nodes(self, node_indices):
+        """
+        Return node indices on the surface without medial wall (e.g. nearest source nodes, one per
+        cortex node) to the full surface, both their positions and their values.
+        Negative indices and the medial wall are set to -1.
+        """
+        node_indices = np.asarray(node_indices)
+        data = np.full(self.n_nodes, -1, dtype=np.int64)
+        valid = node_indices >= 0
+        data[self.cortex[valid]] = self.cortex[node_indices[valid]]
+        return data
+
+
+def cortex_mesh(surf, cortex):
+    """
+    Return surf if it already is a CortexMesh, otherwise build one from surf and cortex.
+    """
+    if isinstance(surf, CortexMesh):
+        return surf
+    return CortexMesh(surf, cortex)
+
+
+def surf_graph(vertices, triangles):
+    """
+    Build the edge graph of a triangular mesh.
+
+    Returns a symmetric scipy.sparse.csr_matrix of shape (n_nodes, n_nodes) holding the euclidean
+    length of each mesh edge, suitable for scipy.sparse.csgraph shortest path routines.
+    """
+
+    import scipy.sparse
+
+    n = len(vertices)
+    triangles = np.asarray(triangles, dtype=np.int64)
+    edges = np.sort(np.vstack([triangles[:, [0, 1]], triangles[:, [1, 2]], triangles[:, [2, 0]]]), axis=1)
+    # each edge appears in two triangles, keep it once
+    keys = np.unique(edges[:, 0] * n + edges[:, 1])
+    start, end = np.divmod(keys, n)
+    lengths = np.linalg.norm(vertices[start] - vertices[end], axis=1)
+
+    graph = scipy.sparse.coo_matrix((lengths, (start, end)), shape=(n, n))
+    return (graph + graph.T).tocsr()
+
+
+def find_node_match(simple_vertices, complex_vertices, cache_file=None):
     """
     Thanks to juhuntenburg.
     Functions taken from https://github.com/juhuntenburg/brainsurfacescripts
 
     Finds those points on the complex mesh that correspond best to the
     simple mesh while forcing a one-to-one mapping.
+
+    The KD-tree of the complex mesh is built once, and conflicts between simple
+    vertices mapped to the same complex vertex are resolved with vectorized
+    operations: the lowest simple index keeps the complex vertex, the others
+    move on to their next nearest neighbour.
+
+    If cache_file (a .npz path) is given and holds the mapping of the same
+    vertices (checked by a hash of both vertex arrays), the mapping is loaded
+    from it instead of being computed; otherwise the computed mapping is saved
+    there, so that e.g. a native to template mapping is only computed once per
+    subject.
+
+    Returns the complex mesh index for each simple vertex and the distances to
+    the nearest neighbours queried.
     """
 
+    import os
     import scipy.spatial
+    from surfdist.cache import _hash
+
+    if cache_file is not None:
+        cache_file = str(cache_file)
+        if not cache_file.endswith('.npz'):
+            cache_file += '.npz'
+        key = _hash(np.asarray(simple_vertices), np.asarray(complex_vertices))
+        if os.path.exists(cache_file):
+            with np.load(cache_file) as cached:
+                if 'key' in cached and str(cached['key']) == key:
+                    return cached['idx'], cached['inaccuracy']
+
+    n_simple = simple_vertices.shape[0]
+    n_complex = complex_vertices.shape[0]
+    if n_simple > n_complex:
+        raise ValueError('The simple mesh has more vertices than the complex mesh, '
+                         'no one-to-one mapping exists.')
+
+    tree = scipy.spatial.cKDTree(complex_vertices)
 
     # make array for writing in final voronoi seed indices
-    voronoi_seed_idx = np.zeros((simple_vertices.shape[0],), dtype='int64')-1
-    missing = np.where(voronoi_seed_idx == -1)[0].shape[0]
-    mapping_single = np.zeros_like(voronoi_seed_idx)
+    voronoi_seed_idx = np.zeros((n_simple,), dtype='int64')-1
+    # simple vertex currently holding each complex vertex (n_simple if none)
+    owner = np.zeros((n_complex,), dtype='int64')+n_simple
+    missing_idx = np.arange(n_simple)
 
     neighbours = 0
     col = 0
 
-    while missing != 0:
-
-        neighbours += 100
-        # find nearest neighbours
-        inaccuracy, mapping = scipy.spatial.KDTree(
-            complex_vertices).query(simple_vertices, k=neighbours)
-        # go through columns of nearest neighbours until unique mapping is
-        # achieved, if not before end of neighbours, extend number of
-        # neighbours
-        while col < neighbours:
-            # find all missing voronoi seed indices
-            missing_idx = np.where(voronoi_seed_idx == -1)[0]
-            missing = missing_idx.shape[0]
-            if missing == 0:
-                break
-            else:
-                # for missing entries fill in next neighbour
-                mapping_single[missing_idx] = np.copy(
-                    mapping[missing_idx, col])
-                # find unique values in mapping_single
-                unique, double_idx = np.unique(
-                    mapping_single, return_inverse=True)
-                # empty voronoi seed index
-                voronoi_seed_idx = np.zeros(
-                    (simple_vertices.shape[0],), dtype='int64')-1
-                # fill voronoi seed idx with unique values
-                for u in range(unique.shape[0]):
-                    # find the indices of this value in mapping
-                    entries = np.where(double_idx == u)[0]
-                    # set the first entry to the value
-                    voronoi_seed_idx[entries[0]] = unique[u]
-                # go to next column
-                col += 1
+    while missing_idx.shape[0] != 0:
+
+        if col == neighbours:
+            # find nearest neighbours, extending the number of neighbours
+            neighbours = min(neighbours + 100, n_complex)
+            inaccuracy, mapping = tree.query(simple_vertices, k=neighbours)
+            mapping = mapping.reshape(n_simple, -1)
+            inaccuracy = inaccuracy.reshape(n_simple, -1)
+
+        # for missing entries fill in next neighbour, the lowest simple index
+        # claiming a complex vertex keeps it
+        candidates = mapping[missing_idx, col]
+        previous = owner[candidates]
+        np.minimum.at(owner, candidates, missing_idx)
+        won = owner[candidates] == missing_idx
+
+        # simple vertices that lost their complex vertex to a lower index
+        lost = np.unique(previous[(owner[candidates] != previous) & (previous < n_simple)])
+
+        voronoi_seed_idx[missing_idx[won]] = candidates[won]
+        voronoi_seed_idx[lost] = -1
+        missing_idx = np.union1d(missing_idx[~won], lost)
+
+        # go to next column
+        col += 1
+
+    if cache_file is not None:
+        np.savez(cache_file, idx=voronoi_seed_idx, inaccuracy=inaccuracy, key=key)
 
     return voronoi_seed_idx, inaccuracy
@@ -1,3 +1,14 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import matplotlib.image
+import matplotlib.pyplot as plt
+import numpy as np
+from matplotlib.colors import LightSource
+from matplotlib.figure import Figure
+from mpl_toolkits.mplot3d.art3d import Poly3DCollection
+
+
 def viz(coords, faces, stat_map=None,
         elev=0, azim=0, cmap='coolwarm',
         threshold=None, alpha='auto',
@@ -36,93 +47,295 @@ def viz(coords, faces, stat_map=None,
                  thresholding will show shadows.
     figsize : tuple of intergers, dimensions of the figure that is produced.
 
+    To render several maps or views of one mesh, e.g. quality control images for
+    every subject, use a SurfaceRenderer, which builds the figure once.
+
 
     Output
     ------
-    Matplotlib figure object
+    Matplotlib figure and 3d axes objects
     '''
 
-    import numpy as np
-    import matplotlib.pyplot as plt
-    import matplotlib.tri as tri
-    from mpl_toolkits.mplot3d import Axes3D
+    renderer = SurfaceRenderer(coords, faces, figsize=figsize)
+    return renderer.render(stat_map, elev=elev, azim=azim, cmap=cmap, threshold=threshold,
+                           alpha=alpha, bg_map=bg_map, bg_on_stat=bg_on_stat)
 
-    # load mesh and derive axes limits
-    faces = np.array(faces, dtype=int)
-    limits = [coords.min(), coords.max()]
 
-    # set alpha if in auto mode
-    if alpha == 'auto':
-        if bg_map is None:
-            alpha = .5
-        else:
-            alpha = 1
+def render_batch(jobs, basenames=None, montage=None, mesh=None, views=((0, 0), (0, 180)),
+                 n_jobs=1, figsize=None, dpi=None, **render_args):
+
+    ''' Render many maps and views to PNG files, e.g. quality control images for every subject.
 
-    # if cmap is given as string, translate to matplotlib cmap
-    if type(cmap) == str:
-        cmap = plt.cm.get_cmap(cmap)
+    Jobs are rendered headless (Agg) in a pool of n_jobs worker processes. Jobs on the same mesh
+    (the same coords and faces arrays) share one SurfaceRenderer, so the mesh is set up once and
+    only the face colours and view change; with a template mesh the maps are split evenly over
+    the workers.
+
+    Inputs
+    -------
+    jobs : list of (coords, faces, stat_map) tuples, or of stat maps if mesh is given
+    basenames : optional list of output paths without extension, one per job. Every view of a job
+                is written to basename + '_<elev>_<azim>.png'.
+    montage : optional path of a single PNG holding all renderings, with one row per job and one
+              column per view. The montage is assembled in memory.
+    mesh : optional (coords, faces) of a template mesh shared by all jobs
+    views : list of (elev, azim) pairs, see viz
+    n_jobs : number of worker processes, -1 uses all cores
+    figsize, dpi : size and resolution of each rendering
+    render_args : further arguments of viz, e.g. bg_map, cmap or threshold
+
+    Output
+    ------
+    list of the written file names, the montage last
+    '''
 
-    # initiate figure and 3d axes
-    if figsize is not None:
-        fig = plt.figure(figsize=figsize)
+    if basenames is None and montage is None:
+        raise ValueError('nothing to write, give basenames and/or montage')
+    if basenames is not None and len(basenames) != len(jobs):
+        raise ValueError('one basename per job is needed')
+    if mesh is not None:
+        jobs = [(mesh[0], mesh[1], stat_map) for stat_map in jobs]
+    views = [tuple(view) for view in views]
+
+    # jobs on the same mesh are rendered by one renderer per worker
+    groups = {}
+    for index, (coords, faces, _) in enumerate(jobs):
+        groups.setdefault((id(coords), id(faces)), []).append(index)
+
+    n_jobs = os.cpu_count() if n_jobs is not None and n_jobs < 0 else n_jobs
+    n_jobs = max(min(n_jobs or 1, len(jobs)), 1)
+    tasks = []
+    for indices in groups.values():
+        coords, faces, _ = jobs[indices[0]]
+        for chunk in np.array_split(indices, min(n_jobs, len(indices))):
+            items = [(i, jobs[i][2], None if basenames is None else basenames[i]) for i in chunk]
+            tasks.append((coords, faces, items, views, figsize, dpi, montage is not None, render_args))
+
+    filenames = []
+    images = None
+    use_pool = n_jobs > 1 and len(tasks) > 1
+    if not use_pool:
+        results = (_render_jobs(*task) for task in tasks)
     else:
-        fig = plt.figure()
-    ax = fig.add_subplot(111, projection='3d', xlim=limits, ylim=limits)
-    ax.view_init(elev=elev, azim=azim)
-    ax.set_axis_off()
-
-    # plot mesh without data
-    p3dcollec = ax.plot_trisurf(coords[:, 0], coords[:, 1], coords[:, 2],
-                                triangles=faces, linewidth=0.,
-                                antialiased=False,
-                                color='white')
-
-    # If depth_map and/or stat_map are provided, map these onto the surface
-    # set_facecolors function of Poly3DCollection is used as passing the
-    # facecolors argument to plot_trisurf does not seem to work
-    if bg_map is not None or stat_map is not None:
-
-        face_colors = np.ones((faces.shape[0], 4))
-        face_colors[:, :3] = .5*face_colors[:, :3]
-
-        if bg_map is not None:
-            bg_data = bg_map
-            if bg_data.shape[0] != coords.shape[0]:
-                raise ValueError('The bg_map does not have the same number '
-                                 'of vertices as the mesh.')
-            bg_faces = np.mean(bg_data[faces], axis=1)
-            bg_faces = bg_faces - bg_faces.min()
-            bg_faces = bg_faces / bg_faces.max()
-            face_colors = plt.cm.gray_r(bg_faces)
+        executor = ProcessPoolExecutor(max_workers=n_jobs)
+        results = executor.map(_render_jobs, *zip(*tasks))
+    try:
+        for written, rendered in results:
+            filenames.extend(written)
+            for index, view_images in rendered:
+                if images is None:
+                    height, width = view_images[0].shape[:2]
+                    images = np.zeros((len(jobs) * height, len(views) * width, 4), dtype=np.uint8)
+                for j, image in enumerate(view_images):
+                    images[index * height:(index + 1) * height, j * width:(j + 1) * width] = image
+    finally:
+        if use_pool:
+            executor.shutdown()
+
+    if montage is not None:
+        matplotlib.image.imsave(montage, images)
+        filenames.append(montage)
+    return filenames
+
+
+def _render_jobs(coords, faces, items, views, figsize, dpi, keep_images, render_args):
+    # render the items (index, stat_map, basename) of one mesh, each image is drawn once
+    renderer = SurfaceRenderer(coords, faces, figsize=figsize, headless=True)
+    if dpi is not None:
+        renderer.fig.set_dpi(dpi)
+    written, rendered = [], []
+    for index, stat_map, basename in items:
+        view_images = []
+        for elev, azim in views:
+            renderer.render(stat_map, elev=elev, azim=azim, **render_args)
+            renderer.fig.canvas.draw()
+            image = np.asarray(renderer.fig.canvas.buffer_rgba())
+            if basename is not None:
+                filename = '%s_%d_%d.png' % (basename, elev, azim)
+                matplotlib.image.imsave(filename, image)
+                written.append(filename)
+            if keep_images:
+                view_images.append(image.copy())
+        if keep_images:
+            rendered.append((index, view_images))
+    return written, rendered
+
+
+class SurfaceRenderer(object):
+    ''' Figure of a cortical surface mesh for rendering many maps and views.
+
+    The mesh is added to the figure once as a Poly3DCollection. Every call of
+    render only sets the face colours and the view, so rendering further maps
+    or views of the same mesh skips the mesh setup. Face colours are computed in
+    buffers allocated once per renderer.
+
+    Inputs
+    -------
+    coords : numpy array of shape (n_nodes,3), node coordinates of the mesh
+    faces : numpy array of shape (n_faces, 3), node indices of the triangles
+    figsize : tuple of intergers, dimensions of the figure that is produced.
+    headless : boolean, draw on a matplotlib Figure with an Agg canvas instead
+               of a pyplot figure, for writing images without a display. Such
+               figures are not shown by plt.show and need no plt.close.
+
+    Example
+    -------
+    renderer = SurfaceRenderer(surf[0], surf[1], headless=True)
+    for azim, view in [(0, 'medial'), (180, 'lateral')]:
+        renderer.render(dist, azim=azim, bg_map=sulc, bg_on_stat=True)
+        renderer.savefig('dist_%s.png' % view)
+    '''
+
+    def __init__(self, coords, faces, figsize=None, headless=False):
+        coords = np.asarray(coords, dtype=np.float64)
+        faces = np.asarray(faces, dtype=np.intp)
+        self.n_nodes = len(coords)
+        # contiguous node indices of each corner
+        self._corners = [np.ascontiguousarray(faces[:, i]) for i in range(3)]
+
+        if headless:
+            from matplotlib.backends.backend_agg import FigureCanvasAgg
+            self.fig = Figure(figsize=figsize)
+            FigureCanvasAgg(self.fig)
+        else:
+            self.fig = plt.figure(figsize=figsize)
+        limits = [coords.min(), coords.max()]
+        self.ax = self.fig.add_subplot(111, projection='3d', xlim=limits, ylim=limits)
+        self.ax.set_axis_off()
+        # z limits are autoscaled like plot_trisurf does
+        self.ax.auto_scale_xyz(coords[:, 0], coords[:, 1], coords[:, 2], False)
+
+        triangles = coords[faces]
+        normals = np.cross(triangles[:, 1] - triangles[:, 0], triangles[:, 2] - triangles[:, 0])
+        self.collection = Poly3DCollection(triangles, linewidth=0., antialiased=False)
+        self.ax.add_collection3d(self.collection)
+        del triangles
+
+        # shading of the bare mesh, as plot_trisurf does for a single color
+        lengths = np.linalg.norm(normals, axis=1)
+        lengths[lengths == 0] = 1.
+        normals /= lengths[:, None]
+        shade = normals @ LightSource(azdeg=225, altdeg=19.4712).direction
+        self._shade = .3 + .7 * (shade + 1.) / 2.
+
+        n_faces = len(faces)
+        self._values = np.empty(n_faces)
+        self._scratch = np.empty(n_faces)
+        self._index = np.empty(n_faces, dtype=np.intp)
+        self._colors = np.empty((n_faces, 4))
+        self._stat_colors = np.empty((n_faces, 4))
+        self._luts = {}
+
+    def render(self, stat_map=None, elev=0, azim=0, cmap='coolwarm', threshold=None,
+               alpha='auto', bg_map=None, bg_on_stat=False):
+        ''' Colour the mesh by stat_map and bg_map and set the view.
+
+        The arguments are those of viz. Returns the figure and 3d axes, which
+        are the same for all calls.
+        '''
+
+        # set alpha if in auto mode
+        if alpha == 'auto':
+            if bg_map is None:
+                alpha = .5
+            else:
+                alpha = 1
+
+        self.collection.set_facecolors(self.face_colors(stat_map, cmap=cmap, threshold=threshold,
+                                                        alpha=alpha, bg_map=bg_map,
+                                                        bg_on_stat=bg_on_stat))
+        self.ax.view_init(elev=elev, azim=azim)
+        return self.fig, self.ax
+
+    def savefig(self, filename, **kwargs):
+        ''' Write the current rendering to filename, see matplotlib savefig. '''
+        self.fig.savefig(filename, **kwargs)
+
+    def close(self):
+        ''' Release a pyplot figure (not needed with headless). '''
+        plt.close(self.fig)
+
+    def face_colors(self, stat_map=None, cmap='coolwarm', threshold=None, alpha=1.,
+                    bg_map=None, bg_on_stat=False):
+        ''' RGBA colour of each face, see viz for the arguments.
+
+        Returns an array of shape (n_faces, 4) that is overwritten by the next
+        call.
+        '''
+        colors = self._colors
+
+        if bg_map is None and stat_map is None:
+            colors[:, :3] = self._shade[:, None]
+            colors[:, 3] = 1.
+            return colors
+
+        if bg_map is None:
+            colors[:] = (.5, .5, .5, 1.)
+        else:
+            bg_faces = self.face_values(bg_map, 'bg_map')
+            bg_faces -= bg_faces.min()
+            bg_faces /= bg_faces.max()
+            self._lookup('gray_r', bg_faces, colors)
 
         # modify alpha values of background
-        face_colors[:, 3] = alpha*face_colors[:, 3]
+        colors[:, 3] *= alpha
 
         if stat_map is not None:
-            stat_map_data = stat_map
-            stat_map_faces = np.mean(stat_map_data[faces], axis=1)
+            stat_map_faces = self.face_values(stat_map, 'stat_map')
 
             # Ensure symmetric colour range, based on Nilearn helper function:
             # https://github.com/nilearn/nilearn/blob/master/nilearn/plotting/img_plotting.py#L52
             vmax = max(-np.nanmin(stat_map_faces), np.nanmax(stat_map_faces))
             vmin = -vmax
 
+            kept = None
             if threshold is not None:
-                kept_indices = np.where(abs(stat_map_faces) >= threshold)[0]
-                stat_map_faces = stat_map_faces - vmin
-                stat_map_faces = stat_map_faces / (vmax-vmin)
-                if bg_on_stat:
-                    face_colors[kept_indices] = cmap(stat_map_faces[kept_indices]) * face_colors[kept_indices]
-                else:
-                    face_colors[kept_indices] = cmap(stat_map_faces[kept_indices])
+                kept = abs(stat_map_faces) >= threshold
+            stat_map_faces -= vmin
+            stat_map_faces /= (vmax-vmin)
+
+            stat_colors = self._lookup(cmap, stat_map_faces, self._stat_colors)
+            if bg_on_stat:
+                stat_colors *= colors
+            if kept is None:
+                colors[:] = stat_colors
             else:
-                stat_map_faces = stat_map_faces - vmin
-                stat_map_faces = stat_map_faces / (vmax-vmin)
-                if bg_on_stat:
-                    face_colors = cmap(stat_map_faces) * face_colors
-                else:
-                    face_colors = cmap(stat_map_faces)
+                colors[kept] = stat_colors[kept]
+
+        return colors
+
+    def face_values(self, node_values, name='node_values'):
+        ''' Mean of node_values over the three nodes of each face.
+
+        Returns an array of shape (n_faces,) that is overwritten by the next
+        call.
+        '''
+        node_values = np.asarray(node_values, dtype=np.float64)
+        if node_values.shape[0] != self.n_nodes:
+            raise ValueError('The %s does not have the same number '
+                             'of vertices as the mesh.' % name)
+        values, scratch = self._values, self._scratch
+        np.take(node_values, self._corners[0], out=values)
+        for corner in self._corners[1:]:
+            values += np.take(node_values, corner, out=scratch)
+        values /= 3.
+        return values
 
-        p3dcollec.set_facecolors(face_colors)
+    def _lookup(self, cmap, values, out):
+        # colormap lookup writing into out, values in [0, 1], nan gets the bad colour
+        key = cmap if isinstance(cmap, str) else id(cmap)
+        lut = self._luts.get(key)
+        if lut is None or (key != cmap and lut[0] is not cmap):
+            colormap = plt.get_cmap(cmap)
+            lut = self._luts[key] = (cmap, colormap(np.linspace(0, 1, colormap.N)), colormap(np.nan))
+        _, table, bad = lut
 
-    return fig, ax
+        index = self._index
+        scratch = np.multiply(values, len(table), out=self._scratch)
+        nan = np.isnan(scratch)
+        scratch[nan] = 0
+        np.clip(scratch, 0, len(table) - 1, out=scratch)
+        np.copyto(index, scratch, casting='unsafe')
+        np.take(table, index, axis=0, out=out)
+        out[nan] = bad
+        return out
@@ -0,0 +1,42 @@
+import numpy as np
+import nibabel as nib
+import pytest
+
+from benchmarks import meshes
+
+
+def icosphere(n_subdivisions=3, radius=50.):
+    """
+    Build a triangulated sphere by repeated subdivision of an icosahedron, see benchmarks.meshes.
+    """
+    vertices, faces = meshes.icosphere(10 * 4 ** n_subdivisions + 2, radius)
+    return vertices.copy(), faces.copy()
+
+
+@pytest.fixture(scope='session')
+def surf():
+    return icosphere(3)
+
+
+@pytest.fixture(scope='session')
+def cortex(surf):
+    # fake medial wall: a cap around the +x pole
+    return np.where(surf[0][:, 0] < 35.)[0]
+
+
+@pytest.fixture(scope='session')
+def annot(surf, tmp_path_factory):
+    """
+    Freesurfer annotation with 'Unknown', 'Medial_wall' and eight longitudinal labels.
+    """
+    vertices = surf[0]
+    angle = np.arctan2(vertices[:, 1], vertices[:, 2])
+    labels = 2 + np.digitize(angle, np.linspace(-np.pi, np.pi, 9)[1:-1])
+    labels[vertices[:, 0] >= 35.] = 1
+    names = ['Unknown', 'Medial_wall'] + ['L%d' % i for i in range(8)]
+    ctab = np.zeros((len(names), 5), dtype=np.int32)
+    ctab[:, :3] = np.arange(len(names))[:, None] * 20
+    ctab[:, 4] = ctab[:, 0] + ctab[:, 1] * 2 ** 8 + ctab[:, 2] * 2 ** 16
+    filename = str(tmp_path_factory.mktemp('annot') / 'lh.test.annot')
+    nib.freesurfer.write_annot(filename, labels, ctab, names)
+    return filename
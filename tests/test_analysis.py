@@ -0,0 +1,250 @@
+import threading
+
+import gdist
+import numpy as np
+import pytest
+import scipy.sparse
+
+from .conftest import icosphere
+from surfdist import analysis, load, utils
+from surfdist.utils import surf_keep_cortex, translate_src
+
+
+def test_dist_calc_matrix_matches_dense(surf, cortex, annot):
+    dist_mat, rois = analysis.dist_calc_matrix(surf, cortex, annot, verbose=False)
+    assert rois == ['L%d' % i for i in range(8)]
+
+    # reference: stack full distance fields of all regions
+    vertices, triangles = surf_keep_cortex(surf, cortex)
+    nodes = [translate_src(load.load_freesurfer_label(annot, roi), cortex) for roi in rois]
+    dist_roi = np.array([gdist.compute_gdist(vertices, triangles, source_indices=n) for n in nodes])
+    expected = np.array([np.min(dist_roi[:, n], axis=1) for n in nodes])
+
+    # summary 'min' fills the matrix symmetrically from the bounded solves
+    np.testing.assert_allclose(dist_mat, expected, rtol=1e-12)
+    np.testing.assert_array_equal(dist_mat, dist_mat.T)
+    np.testing.assert_array_equal(np.diag(dist_mat), 0)
+
+    mean_mat, _ = analysis.dist_calc_matrix(surf, cortex, annot, summary='mean', verbose=False)
+    np.testing.assert_allclose(mean_mat, np.array([np.mean(dist_roi[:, n], axis=1) for n in nodes]), rtol=1e-12)
+
+
+def test_dist_calc_matrix_undefined_summary(surf, cortex, annot):
+    with pytest.raises(ValueError):
+        analysis.dist_calc_matrix(surf, cortex, annot, summary='sum', verbose=False)
+
+
+def test_dist_calc_matrix_parallel_identical(surf, cortex, annot):
+    serial, _ = analysis.dist_calc_matrix(surf, cortex, annot, summary='mean', verbose=False)
+    parallel, _ = analysis.dist_calc_matrix(surf, cortex, annot, summary='mean', verbose=False, n_jobs=3)
+    assert serial.tobytes() == parallel.tobytes()
+
+
+def test_dist_calc_accepts_cortex_mesh(surf, cortex):
+    src = cortex[:5]
+    mesh = utils.CortexMesh(surf, cortex)
+    np.testing.assert_array_equal(analysis.dist_calc(mesh, None, src), analysis.dist_calc(surf, cortex, src))
+
+
+def test_zone_calc_nearest_source(surf, cortex):
+    src = [cortex[[0]], cortex[[200]], cortex[[400, 401]]]
+    zone = analysis.zone_calc(surf, cortex, src)
+
+    fields = np.array([analysis.dist_calc(surf, cortex, s)[cortex] for s in src])
+    np.testing.assert_array_equal(zone[cortex], np.argmin(fields, axis=0) + 1)
+    assert np.all(zone[np.setdiff1d(np.arange(len(surf[0])), cortex)] == 0)
+    np.testing.assert_array_equal(analysis.zone_calc(surf, cortex, src, n_jobs=2), zone)
+
+
+def test_dist_calc_max_distance(surf, cortex):
+    src = cortex[:5]
+    full = analysis.dist_calc(surf, cortex, src)
+    local = analysis.dist_calc(surf, cortex, src, max_distance=20.)
+
+    near = full[cortex] <= 20.
+    assert near.sum() > len(src)
+    np.testing.assert_allclose(local[cortex][near], full[cortex][near])
+    assert np.all(np.isinf(local[cortex][~near]))
+
+
+def test_local_dist_matrix(surf, cortex, tmp_path):
+    local = analysis.local_dist_matrix(surf, cortex, 15.)
+    n = len(surf[0])
+    assert local.shape == (n, n) and local.format == 'csr'
+    medial_wall = np.setdiff1d(np.arange(n), cortex)
+    assert local[medial_wall].nnz == 0
+
+    node = cortex[10]
+    field = analysis.dist_calc(surf, cortex, [node], max_distance=15.)
+    row = local[node].toarray().ravel()
+    near = np.isfinite(field) & (field > 0)
+    np.testing.assert_allclose(row[near], field[near])
+    assert np.all(row[~near] == 0)
+
+    scipy.sparse.save_npz(tmp_path / 'local.npz', local)
+    assert (scipy.sparse.load_npz(tmp_path / 'local.npz') != local).nnz == 0
+
+
+@pytest.mark.parametrize('method, tolerance', [('dijkstra', 0.15), ('heat', 0.05)])
+def test_dist_calc_approximate_methods(surf, cortex, method, tolerance):
+    src = cortex[:3]
+    exact = analysis.dist_calc(surf, cortex, src)
+    approx = analysis.dist_calc(surf, cortex, src, method=method)
+
+    far = exact > 20.
+    assert np.mean(np.abs(approx[far] - exact[far]) / exact[far]) < tolerance
+    np.testing.assert_array_equal(approx[np.setdiff1d(np.arange(len(surf[0])), cortex)], 0)
+    if method == 'dijkstra':
+        assert np.all(approx[cortex] >= exact[cortex] - 1e-9)
+
+
+def test_dist_calc_matrix_heat_reuses_factorization(surf, cortex, annot, monkeypatch):
+    from surfdist import geodesic
+    built = []
+    original = geodesic.HeatSolver.__init__
+    monkeypatch.setattr(geodesic.HeatSolver, '__init__',
+                        lambda self, *args: built.append(1) or original(self, *args))
+
+    approx, _ = analysis.dist_calc_matrix(surf, cortex, annot, verbose=False, method='heat')
+    exact, _ = analysis.dist_calc_matrix(surf, cortex, annot, verbose=False)
+    assert len(built) == 1
+    assert np.all(np.isfinite(approx)) and np.all(approx >= 0)
+    assert np.corrcoef(approx.ravel(), exact.ravel())[0, 1] > 0.9
+
+
+def test_heat_solver_released_with_mesh(surf, cortex):
+    import gc
+    import weakref
+    from surfdist import geodesic
+    mesh = utils.CortexMesh(surf, cortex)
+    analysis.dist_calc(mesh, None, cortex[:5], method='heat')
+    solver = weakref.ref(geodesic._last_solver['heat'][2])
+    del mesh
+    gc.collect()
+    assert solver() is None and 'heat' not in geodesic._last_solver
+
+
+def test_dist_calc_into_memmap(surf, cortex, annot, tmp_path):
+    src = cortex[:5]
+    expected = analysis.dist_calc(surf, cortex, src)
+
+    group = np.lib.format.open_memmap(str(tmp_path / 'group.npy'), mode='w+', dtype=np.float32,
+                                      shape=(2, len(surf[0])))
+    group[0] = -1
+    result = analysis.dist_calc(surf, cortex, src, out=group[0])
+    assert np.shares_memory(result, group)
+    np.testing.assert_allclose(group[0], expected, rtol=1e-6)
+    assert analysis.dist_calc(surf, cortex, src, dtype=np.float32).dtype == np.float32
+
+    dist_mat, _ = analysis.dist_calc_matrix(surf, cortex, annot, verbose=False, dtype=np.float32)
+    assert dist_mat.dtype == np.float32
+
+
+@pytest.mark.parametrize('summary', ['min', 'mean'])
+def test_dist_calc_matrix_cancel_and_resume(surf, cortex, annot, summary):
+    full, _ = analysis.dist_calc_matrix(surf, cortex, annot, summary=summary, verbose=False)
+
+    cancel = threading.Event()
+    calls = []
+
+    def progress(n_done, n_total, eta):
+        calls.append((n_done, n_total))
+        assert eta >= 0
+        if n_done == 3:
+            cancel.set()
+
+    partial, rois, completed = analysis.dist_calc_matrix(surf, cortex, annot, summary=summary, verbose=False,
+                                                         progress=progress, cancel=cancel)
+    assert calls == [(1, 8), (2, 8), (3, 8)]
+    np.testing.assert_array_equal(completed, np.arange(8) < 3)
+    np.testing.assert_array_equal(partial[:, :3], full[:, :3])
+    assert np.isnan(partial[0, 3:]).all() == (summary == 'mean')
+
+    dist_mat, _, completed = analysis.dist_calc_matrix(surf, cortex, annot, summary=summary, verbose=False,
+                                                       cancel=threading.Event(), out=partial, completed=completed)
+    assert completed.all()
+    np.testing.assert_array_equal(dist_mat, full)
+
+
+def test_zone_calc_cancel(surf, cortex):
+    src = [cortex[[0]], cortex[[200]], cortex[[400]]]
+    cancel = threading.Event()
+    cancel.set()
+    zone, completed = analysis.zone_calc(surf, cortex, src, cancel=cancel)
+    assert not completed.any()
+    assert not zone.any()
+
+
+@pytest.mark.parametrize('method', ['exact', 'dijkstra'])
+def test_distance_field_updates(surf, cortex, method):
+    src = np.random.default_rng(0).choice(cortex, 30, replace=False)
+    field = analysis.DistanceField(surf, cortex, src[10:], method=method)
+    np.testing.assert_array_equal(field.distance, analysis.dist_calc(surf, cortex, src[10:], method=method))
+
+    field.add_sources(src[:10])
+    field.remove_sources(src[20:])
+    np.testing.assert_array_equal(field.sources, np.sort(src[:20]))
+    np.testing.assert_allclose(field.distance, analysis.dist_calc(surf, cortex, src[:20], method=method),
+                               rtol=1e-12, atol=1e-12)
+
+    # every cortex node is labelled with a current source, the medial wall with -1
+    nearest = field.nearest
+    assert set(nearest[cortex]) <= set(src[:20])
+    np.testing.assert_array_equal(nearest[src[:20]], src[:20])
+    assert (np.delete(nearest, cortex) == -1).all()
+    if method == 'dijkstra':
+        per_source = np.array([analysis.dist_calc(surf, cortex, [s], method=method) for s in np.sort(src[:20])])
+        np.testing.assert_allclose(per_source[np.searchsorted(np.sort(src[:20]), nearest[cortex]), cortex],
+                                   field.distance[cortex])
+
+    field.remove_sources(src)
+    assert np.isinf(field.distance[cortex]).all()
+    assert (field.nearest == -1).all()
+
+
+@pytest.mark.parametrize('method', ['exact', 'dijkstra'])
+def test_distance_field_border_edits(method):
+    # a contiguous wedge shaped label, edited at its border; the finer mesh has nodes whose nearest
+    # remaining source lies beyond the sources of their neighbours
+    surf = icosphere(4)
+    vertices = surf[0]
+    cortex = np.where(vertices[:, 0] < 35.)[0]
+    angle = np.arctan2(vertices[cortex, 1], vertices[cortex, 2])
+    label = cortex[(angle > 0.) & (angle < np.pi / 4)]
+    field = analysis.DistanceField(surf, cortex, label, method=method)
+
+    far = label[np.argsort(np.linalg.norm(vertices[label] - vertices[label].mean(axis=0), axis=1))[-10:]]
+    field.remove_sources(far)
+    np.testing.assert_allclose(field.distance, analysis.dist_calc(surf, cortex, np.setdiff1d(label, far),
+                                                                  method=method), rtol=1e-12, atol=1e-12)
+
+    # nodes just outside the label, added and removed again
+    outside = cortex[(angle > np.pi / 4) & (angle < np.pi / 4 + .15)][:5]
+    field.add_sources(outside)
+    field.remove_sources(outside)
+    np.testing.assert_allclose(field.distance, analysis.dist_calc(surf, cortex, np.setdiff1d(label, far),
+                                                                  method=method), rtol=1e-12, atol=1e-12)
+    assert set(field.nearest[cortex]) <= set(np.setdiff1d(label, far))
+
+
+def test_dist_calc_return_nearest(surf, cortex):
+    src = cortex[[0, 150, 300, 450]]
+    dist, nearest = analysis.dist_calc(surf, cortex, src, method='dijkstra', return_nearest=True)
+    np.testing.assert_array_equal(dist, analysis.dist_calc(surf, cortex, src, method='dijkstra'))
+    np.testing.assert_array_equal(nearest[src], src)
+    assert (np.delete(nearest, cortex) == -1).all()
+    # edge path distances are attained by the nearest source
+    per_source = np.array([analysis.dist_calc(surf, cortex, [s], method='dijkstra') for s in src])
+    np.testing.assert_allclose(per_source[np.searchsorted(src, nearest[cortex]), cortex], dist[cortex])
+
+    # exact geodesics: the same zones as zone_calc away from the borders, and near them a source
+    # only slightly farther away than the closest one
+    _, nearest = analysis.dist_calc(surf, cortex, src, return_nearest=True)
+    zone = analysis.zone_calc(surf, cortex, [[s] for s in src])
+    assert np.mean(src[zone[cortex].astype(int) - 1] == nearest[cortex]) > .99
+    per_source = np.array([analysis.dist_calc(surf, cortex, [s]) for s in src])
+    excess = per_source[np.searchsorted(src, nearest[cortex]), cortex] - per_source[:, cortex].min(axis=0)
+    assert excess.max() < 1.
+
+    dist, nearest = analysis.dist_calc(surf, cortex, src, max_distance=10., return_nearest=True)
+    assert (nearest[np.isinf(dist)] == -1).all()
@@ -0,0 +1,33 @@
+import os
+
+import numpy as np
+
+from surfdist import analysis, cache, utils
+
+
+def test_dist_calc_cached(surf, cortex, tmp_path, monkeypatch):
+    src = cortex[:5]
+    expected = analysis.dist_calc(surf, cortex, src)
+    np.testing.assert_array_equal(analysis.dist_calc(surf, cortex, src, cache=tmp_path), expected)
+    assert len(os.listdir(tmp_path)) == 1
+
+    # a second run is served from the cache without solving
+    def no_solve(*args):
+        raise AssertionError('solved despite cached field')
+    monkeypatch.setattr(analysis, '_gdist', no_solve)
+    mesh = utils.CortexMesh(surf, cortex)
+    np.testing.assert_array_equal(analysis.dist_calc(mesh, None, src, cache=str(tmp_path)), expected)
+
+
+def test_cache_evicts_least_recently_used(tmp_path):
+    dc = cache.DistanceCache(tmp_path, max_bytes=None)
+    for i in range(3):
+        dc.put(str(i), np.random.default_rng(i).random(1000))
+        os.utime(tmp_path / ('%d.npz' % i), (i, i))
+    dc.get('0')
+
+    sizes = {name: os.path.getsize(tmp_path / name) for name in os.listdir(tmp_path)}
+    dc.max_bytes = sizes['0.npz'] + sizes['2.npz']
+    dc.evict()
+    assert sorted(os.listdir(tmp_path)) == ['0.npz', '2.npz']
+    assert dc.get('1') is None
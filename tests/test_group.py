@@ -0,0 +1,114 @@
+import json
+import os
+
+import nibabel as nib
+import numpy as np
+import pytest
+
+from .conftest import icosphere
+from surfdist import analysis, group, utils
+
+
+def _write_subject(subjects_dir, subject, n_subdivisions, annot_labels=None, scale=1.):
+    vertices, faces = icosphere(n_subdivisions)
+    surf_dir = os.path.join(subjects_dir, subject, 'surf')
+    label_dir = os.path.join(subjects_dir, subject, 'label')
+    os.makedirs(surf_dir)
+    os.makedirs(label_dir)
+    nib.freesurfer.write_geometry(os.path.join(surf_dir, 'lh.sphere.reg'), vertices, faces)
+    nib.freesurfer.write_geometry(os.path.join(surf_dir, 'lh.pial'), vertices * scale, faces)
+
+    cortex = np.where(vertices[:, 0] < 35.)[0]
+    with open(os.path.join(label_dir, 'lh.cortex.label'), 'w') as f:
+        f.write('#!ascii label\n%d\n' % len(cortex))
+        for v in cortex:
+            f.write('%d %f %f %f 0.0\n' % ((v,) + tuple(vertices[v])))
+
+    labels = (vertices[:, 2] > 30.).astype(np.int32)
+    ctab = np.array([[0, 0, 0, 0, 0], [255, 0, 0, 0, 255]], dtype=np.int32)
+    nib.freesurfer.write_annot(os.path.join(label_dir, 'lh.test.annot'), labels, ctab, ['Unknown', 'Pole'])
+    return (vertices * scale, faces), cortex, np.where(labels == 1)[0]
+
+
+def test_run_group_resumes(tmp_path, monkeypatch):
+    subjects_dir = str(tmp_path / 'subjects')
+    _write_subject(subjects_dir, 'fsaverage', 2)
+    expected = []
+    for i, subject in enumerate(['s1', 's2', 's3']):
+        surf, cortex, src = _write_subject(subjects_dir, subject, 3, scale=1. + i / 10.)
+        trg = icosphere(2)[0]
+        idx = utils.find_node_match(trg, icosphere(3)[0])[0]
+        expected.append(analysis.dist_calc(surf, cortex, src)[idx])
+
+    out_file = str(tmp_path / 'group.npy')
+    args = dict(hemi='lh', template='fsaverage', annot='test', source='Pole')
+    result = group.run_group(subjects_dir, ['s1', 's2', 's3'], out_file=out_file, n_jobs=2, **args)
+    assert result.shape == (3, 162) and result.dtype == np.float32
+    np.testing.assert_allclose(np.load(out_file), np.array(expected), rtol=1e-6)
+
+    # pretend the run was killed after the first two subjects
+    with open(out_file + '.json') as f:
+        checkpoint = json.load(f)
+    checkpoint['done'] = ['s2', 's1']
+    with open(out_file + '.json', 'w') as f:
+        json.dump(checkpoint, f)
+
+    computed = []
+    subject_distances = group.subject_distances
+    monkeypatch.setattr(group, 'subject_distances',
+                        lambda subject, **kwargs: computed.append(subject) or subject_distances(subject=subject, **kwargs))
+    result = group.run_group(subjects_dir, ['s1', 's2', 's3'], out_file=out_file, **args)
+    assert computed == ['s3']
+    np.testing.assert_allclose(result, np.array(expected), rtol=1e-6)
+
+
+def _group_subjects(tmp_path):
+    subjects_dir = str(tmp_path / 'subjects')
+    _write_subject(subjects_dir, 'fsaverage', 2)
+    for i, subject in enumerate(['s1', 's2']):
+        _write_subject(subjects_dir, subject, 3, scale=1. + i / 10.)
+    return subjects_dir
+
+
+def test_run_group_restarts_on_changed_dist_args(tmp_path, monkeypatch):
+    subjects_dir = _group_subjects(tmp_path)
+    out_file = str(tmp_path / 'group.npy')
+    args = dict(hemi='lh', template='fsaverage', annot='test', source='Pole')
+    exact = np.array(group.run_group(subjects_dir, ['s1', 's2'], out_file=out_file, **args))
+
+    computed = []
+    subject_distances = group.subject_distances
+    monkeypatch.setattr(group, 'subject_distances',
+                        lambda subject, **kwargs: computed.append(subject) or subject_distances(subject=subject, **kwargs))
+    # the default method spelled out is the same setting, a cache does not change the distances
+    group.run_group(subjects_dir, ['s1', 's2'], out_file=out_file, method='exact',
+                    cache=str(tmp_path / 'cache'), **args)
+    assert computed == []
+
+    dijkstra = group.run_group(subjects_dir, ['s1', 's2'], out_file=out_file, method='dijkstra', **args)
+    assert computed == ['s1', 's2']
+    assert (dijkstra >= exact - 1e-4).all() and (dijkstra > exact + 1e-4).any()
+
+    # numpy scalars are recorded as plain numbers
+    del computed[:]
+    group.run_group(subjects_dir, ['s1', 's2'], out_file=out_file, max_distance=np.float32(20.), **args)
+    group.run_group(subjects_dir, ['s1', 's2'], out_file=out_file, max_distance=20., **args)
+    assert computed == ['s1', 's2']
+
+    # the same subjects in another subjects directory
+    other_dir = str(tmp_path / 'other')
+    os.rename(subjects_dir, other_dir)
+    group.run_group(other_dir, ['s1', 's2'], out_file=out_file, max_distance=20., **args)
+    assert computed == ['s1', 's2'] * 2
+
+
+def test_run_group_checkpoints_before_failure(tmp_path):
+    subjects_dir = _group_subjects(tmp_path)
+    out_file = str(tmp_path / 'group.npy')
+    # s0 has no surfaces, its worker fails
+    with pytest.raises(FileNotFoundError):
+        group.run_group(subjects_dir, ['s0', 's1', 's2'], out_file=out_file, n_jobs=2, hemi='lh',
+                        template='fsaverage', annot='test', source='Pole')
+    with open(out_file + '.json') as f:
+        assert sorted(json.load(f)['done']) == ['s1', 's2']
+    assert (np.load(out_file)[1:] > 0).any()
@@ -0,0 +1,49 @@
+import logging
+import tracemalloc
+
+import numpy as np
+
+from surfdist import analysis, instrument
+
+
+def test_record_stages(surf, cortex, annot):
+    with instrument.record() as records:
+        analysis.dist_calc_matrix(surf, cortex, annot, summary='mean', verbose=False)
+    stages = [r.stage for r in records]
+    assert stages[:3] == ['surf_keep_cortex', 'read_annotation', 'translate_src']
+    assert stages[-1] == 'solves'
+    assert stages.count('solve') == stages.count('summary') == 8
+    for r in records:
+        assert r.wall_time >= 0 and r.cpu_time >= 0
+    if hasattr(tracemalloc, 'reset_peak'):
+        assert all(r.peak_bytes >= 0 for r in records)
+        # the solves stage encloses the solves, so its peak covers theirs
+        assert records[-1].peak_bytes >= max(r.peak_bytes for r in records if r.stage == 'solve')
+    else:
+        assert all(r.peak_bytes is None for r in records)
+    assert records[-1].info == dict(n_sources=8, n_jobs=1)
+
+
+def test_record_callback_and_disabled(surf, cortex, caplog):
+    src = cortex[:5]
+    expected = analysis.dist_calc(surf, cortex, src)
+    with caplog.at_level(logging.DEBUG, logger='surfdist.instrument'):
+        with instrument.record(instrument.log, memory=False) as records:
+            dist = analysis.dist_calc(surf, cortex, src, method='dijkstra')
+    np.testing.assert_array_less(expected - 1e-9, dist)
+    assert [r.stage for r in records] == ['surf_keep_cortex', 'translate_src', 'solve', 'recort']
+    assert records[2].info == dict(n_nodes=5, method='dijkstra')
+    assert all(r.peak_bytes is None for r in records)
+    assert [r.stage for r in caplog.records] == [r.stage for r in records]
+
+    # nothing is recorded outside of record
+    assert instrument.stage('solve') is instrument.stage('recort')
+    analysis.dist_calc(surf, cortex, src)
+    assert len(records) == 4
+
+
+def test_record_parallel_solves(surf, cortex):
+    src = [cortex[[0]], cortex[[200]], cortex[[400]]]
+    with instrument.record() as records:
+        analysis.zone_calc(surf, cortex, src, n_jobs=2)
+    assert [r.stage for r in records] == ['surf_keep_cortex', 'translate_src'] + ['summary'] * 3 + ['solves', 'recort']
@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+
+from surfdist import load
+
+
+@pytest.mark.parametrize('out_format', ['csv', 'npy', 'hdf5', 'gifti'])
+def test_save_and_stack_dist(tmp_path, out_format):
+    if out_format == 'hdf5':
+        pytest.importorskip('h5py')
+    rows = np.random.default_rng(0).random((3, 50)).astype(np.float32)
+
+    files = [load.save_dist(row, str(tmp_path / ('sub%d' % i)), out_format) for i, row in enumerate(rows)]
+    assert files[0].endswith(load.dist_formats[out_format])
+    np.testing.assert_allclose(load.load_dist(files[1]), rows[1], rtol=1e-6)
+
+    stacked = load.stack_dist(files, str(tmp_path / 'group'), out_format)
+    np.testing.assert_allclose(load.load_dist(stacked).reshape(3, 50), rows, rtol=1e-6)
+
+
+def test_annotation_index(annot, tmp_path):
+    import os
+    import shutil
+    import nibabel as nib
+
+    labels, _, names = nib.freesurfer.read_annot(annot)
+    annotation = load.read_annotation(annot)
+    assert load.read_annotation(annot) is annotation
+    assert load.get_freesurfer_label(annot, verbose=False) == names
+    # changing the returned list leaves the cached annotation intact
+    load.get_freesurfer_label(annot, verbose=False).remove(names[0])
+    assert load.get_freesurfer_label(annot, verbose=False) == names
+
+    for i, name in enumerate(annotation.label_names):
+        expected = np.where(labels == i)[0]
+        np.testing.assert_array_equal(annotation.label_nodes(i), expected)
+        nodes = load.load_freesurfer_label(annot, name)
+        assert nodes.shape == (1, len(expected)) and nodes.dtype == np.int32
+        np.testing.assert_array_equal(nodes[0], expected)
+        assert len(expected) == 0 or np.shares_memory(nodes, annotation.order)
+
+    # a modified file is parsed again
+    copy = str(tmp_path / 'lh.copy.annot')
+    shutil.copy(annot, copy)
+    first = load.read_annotation(copy)
+    ctab = np.array([[0, 0, 0, 0, 0], [255, 0, 0, 0, 255]], dtype=np.int32)
+    nib.freesurfer.write_annot(copy, (labels > 4).astype(np.int32), ctab, ['Unknown', 'Rest'])
+    os.utime(copy, ns=(0, os.stat(copy).st_mtime_ns + 10**9))
+    assert load.read_annotation(copy).label_names == ['Unknown', 'Rest']
+    assert first.label_names != ['Unknown', 'Rest']
@@ -0,0 +1,44 @@
+import heapq
+
+import numpy as np
+
+from surfdist import sample, utils
+
+
+def test_competetive_fast_marching_matches_heap(surf):
+    vertices, triangles = surf
+    graph = utils.surf_graph(vertices, triangles)
+    seeds = np.array([0, 50, 300, 600])
+
+    labels = sample.competetive_fast_marching(vertices, graph, seeds)
+
+    # reference: multi-source dijkstra on a heap, labelling vertices as they are settled
+    expected = np.zeros(len(vertices), dtype=int) - 1
+    heap = [(0., s, i) for i, s in enumerate(seeds)]
+    while heap:
+        length, v, label = heapq.heappop(heap)
+        if expected[v] != -1:
+            continue
+        expected[v] = label
+        row = slice(graph.indptr[v], graph.indptr[v + 1])
+        for nb, w in zip(graph.indices[row], graph.data[row]):
+            if expected[nb] == -1:
+                heapq.heappush(heap, (length + w, nb, label))
+
+    np.testing.assert_array_equal(labels[:, 0], np.arange(len(vertices)))
+    np.testing.assert_array_equal(labels[:, 1], expected)
+
+
+def test_sample_simple_means_per_label():
+    labels = np.array([0, 2, 2, -1, 0, 2, 3, 3])
+    data = np.arange(16, dtype=float).reshape(8, 2)
+
+    lowres = sample.sample_simple(data, labels)
+    assert lowres.shape == (4, 2)
+    np.testing.assert_allclose(lowres[0], data[[0, 4]].mean(axis=0))
+    np.testing.assert_allclose(lowres[2], data[[1, 2, 5]].mean(axis=0))
+    np.testing.assert_allclose(lowres[3], data[[6, 7]].mean(axis=0))
+    assert np.all(np.isnan(lowres[1]))
+
+    averaging = sample.averaging_matrix(labels)
+    np.testing.assert_array_equal(sample.sample_simple(data[:, 1], averaging), lowres[:, 1])
@@ -0,0 +1,90 @@
+import numpy as np
+import pytest
+import scipy.stats
+
+from surfdist import stats
+
+
+@pytest.fixture
+def maps():
+    rng = np.random.default_rng(0)
+    data = rng.gamma(4., 10., size=(50, 300))
+    data[3, :10] = np.inf
+    data[7, 5:15] = np.nan
+    return data
+
+
+def test_running_stats_matches_numpy(maps, tmp_path):
+    # one subject at a time, in batches and merged from two workers give the same result
+    single = stats.RunningStats(maps.shape[1])
+    for row in maps:
+        single.add(row)
+    batched = stats.RunningStats(maps.shape[1]).add(maps[:20]).add(maps[20:])
+    merged = stats.RunningStats(maps.shape[1]).add(maps[:25]).merge(stats.RunningStats(maps.shape[1]).add(maps[25:]))
+
+    masked = np.where(np.isfinite(maps), maps, np.nan)
+    for result in (single, batched, merged):
+        np.testing.assert_array_equal(result.count, np.isfinite(maps).sum(axis=0))
+        np.testing.assert_allclose(result.mean, np.nanmean(masked, axis=0), rtol=1e-12)
+        np.testing.assert_allclose(result.variance, np.nanvar(masked, axis=0, ddof=1), rtol=1e-10)
+
+    single.save(str(tmp_path / 'stats.npz'))
+    loaded = stats.RunningStats.load(str(tmp_path / 'stats.npz'))
+    np.testing.assert_array_equal(loaded.m2, single.m2)
+
+    with pytest.raises(ValueError):
+        single.merge(stats.RunningStats(10))
+
+
+def test_quantile_sketch(maps, tmp_path):
+    sketch = stats.QuantileSketch(maps.shape[1], 0., 200., n_bins=400)
+    sketch.add(maps[:30]).merge(stats.QuantileSketch(maps.shape[1], 0., 200., n_bins=400).add(maps[30:]))
+    assert sketch.counts.sum() + sketch.overflow.sum() == (~np.isnan(maps)).sum()
+    np.testing.assert_array_equal(sketch.overflow, np.isinf(maps).sum(axis=0))
+
+    quantiles = sketch.quantile([.1, .5, .9])
+    expected = np.nanquantile(maps, [.1, .5, .9], axis=0)
+    # within a bin width plus the spacing of the data around the quantile
+    assert np.median(np.abs(quantiles - expected)) < 1.
+    np.testing.assert_array_equal(sketch.median(), quantiles[1])
+
+    sketch.save(str(tmp_path / 'sketch.npz'))
+    np.testing.assert_array_equal(stats.QuantileSketch.load(str(tmp_path / 'sketch.npz')).quantile(.5), quantiles[1])
+
+    empty = stats.QuantileSketch(3, 0., 1.)
+    assert np.isnan(empty.quantile(.5)).all()
+
+
+def test_quantile_sketch_out_of_range(tmp_path):
+    # vertex 0 mostly below the range, vertex 1 mostly above it, vertex 2 within
+    sketch = stats.QuantileSketch(3, 0., 10., n_bins=10)
+    sketch.add([[-5., 15., 5.], [-np.inf, np.inf, 5.], [-1., 11., 5.], [2., 8., np.nan]])
+    np.testing.assert_array_equal(sketch.underflow, [3, 0, 0])
+    np.testing.assert_array_equal(sketch.overflow, [0, 3, 0])
+    np.testing.assert_array_equal(sketch.counts.sum(axis=1), [1, 1, 3])
+
+    low, high = sketch.quantile([.25, .9])
+    np.testing.assert_allclose(low, [-np.inf, 9., 5.25])
+    np.testing.assert_allclose(high, [2.6, np.inf, 5.9])
+
+    sketch.save(str(tmp_path / 'sketch.npz'))
+    loaded = stats.QuantileSketch.load(str(tmp_path / 'sketch.npz'))
+    np.testing.assert_array_equal(loaded.merge(sketch).overflow, [0, 6, 0])
+
+
+def test_welch_t_matches_scipy(maps):
+    group_a, group_b = stats.RunningStats(maps.shape[1]), stats.RunningStats(maps.shape[1])
+    clean = maps[10:]
+    group_a.add(clean[:15])
+    group_b.add(clean[15:] + 2.)
+    t, df, p = stats.welch_t(group_a, group_b)
+    expected = scipy.stats.ttest_ind(clean[:15], clean[15:] + 2., axis=0, equal_var=False)
+    np.testing.assert_allclose(t, expected.statistic, rtol=1e-10)
+    np.testing.assert_allclose(p, expected.pvalue, rtol=1e-8)
+
+
+def test_accumulate(maps):
+    running, sketch = stats.accumulate(iter(maps), low=0., high=200.)
+    np.testing.assert_array_equal(running.count, np.isfinite(maps).sum(axis=0))
+    assert sketch.counts.sum() == running.count.sum()
+    assert isinstance(stats.accumulate(maps), stats.RunningStats)
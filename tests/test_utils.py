@@ -0,0 +1,54 @@
+import numpy as np
+import scipy.spatial
+
+from surfdist import utils
+
+
+def test_cortex_mesh_matches_functions(surf, cortex):
+    mesh = utils.CortexMesh(surf, cortex)
+    vertices, triangles = utils.surf_keep_cortex(surf, cortex)
+    np.testing.assert_array_equal(mesh.vertices, vertices)
+    np.testing.assert_array_equal(mesh.triangles, triangles)
+    assert mesh.triangles.dtype == np.int32
+
+    src = np.array([0, 3, 7, 100, 101, 500])
+    np.testing.assert_array_equal(mesh.translate(src), utils.translate_src(src, cortex))
+
+    data = np.arange(len(cortex), dtype=float)
+    np.testing.assert_array_equal(mesh.recort(data), utils.recort(data, surf, cortex))
+    assert utils.cortex_mesh(mesh, None) is mesh
+
+
+def test_find_node_match_one_to_one(tmp_path, monkeypatch):
+    rng = np.random.default_rng(0)
+    simple = rng.normal(size=(300, 3))
+    complex_ = np.vstack([simple + rng.normal(scale=1e-3, size=simple.shape), rng.normal(size=(500, 3))])
+    complex_ = complex_[::-1]
+
+    idx, inaccuracy = utils.find_node_match(simple, complex_)
+    assert len(np.unique(idx)) == len(simple)
+    np.testing.assert_allclose(complex_[idx], simple, atol=1e-2)
+
+    cache_file = tmp_path / 'match.npz'
+    idx_cached, _ = utils.find_node_match(simple, complex_, cache_file=cache_file)
+    assert cache_file.exists()
+    np.testing.assert_array_equal(idx_cached, idx)
+
+    # the cached mapping is used for the same vertices only
+    computed = []
+    tree = scipy.spatial.cKDTree
+    monkeypatch.setattr(scipy.spatial, 'cKDTree', lambda *args: computed.append(1) or tree(*args))
+    np.testing.assert_array_equal(utils.find_node_match(simple, complex_, cache_file=cache_file)[0], idx)
+    assert computed == []
+    moved = complex_[::-1].copy()
+    idx_moved, _ = utils.find_node_match(simple, moved, cache_file=cache_file)
+    assert computed == [1]
+    np.testing.assert_array_equal(moved[idx_moved], complex_[idx])
+
+
+def test_find_node_match_resolves_conflicts():
+    # both simple vertices are closest to complex vertex 0, the lower index keeps it
+    simple = np.array([[0., 0., 0.], [0.1, 0., 0.]])
+    complex_ = np.array([[0.05, 0., 0.], [1., 0., 0.], [5., 0., 0.]])
+    idx, _ = utils.find_node_match(simple, complex_)
+    np.testing.assert_array_equal(idx, [0, 1])
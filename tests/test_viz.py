@@ -0,0 +1,75 @@
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+import numpy as np
+import pytest
+
+from surfdist import viz
+
+
+def _reference_colors(coords, faces, stat_map, bg_map, threshold, bg_on_stat, cmap='coolwarm'):
+    # face colouring of the original plot_trisurf based viz
+    cmap = plt.get_cmap(cmap)
+    bg_faces = np.mean(bg_map[faces], axis=1)
+    bg_faces = bg_faces - bg_faces.min()
+    bg_faces = bg_faces / bg_faces.max()
+    face_colors = plt.get_cmap('gray_r')(bg_faces)
+    stat_map_faces = np.mean(stat_map[faces], axis=1)
+    vmax = max(-np.nanmin(stat_map_faces), np.nanmax(stat_map_faces))
+    kept = np.ones(len(faces), dtype=bool) if threshold is None else abs(stat_map_faces) >= threshold
+    stat_colors = cmap((stat_map_faces + vmax) / (2 * vmax))
+    if bg_on_stat:
+        stat_colors = stat_colors * face_colors
+    face_colors[kept] = stat_colors[kept]
+    return face_colors
+
+
+@pytest.mark.parametrize('threshold, bg_on_stat', [(None, True), (10., False)])
+def test_face_colors_match_reference(surf, threshold, bg_on_stat):
+    coords, faces = surf
+    stat_map, bg_map = coords[:, 0], coords[:, 1]
+    renderer = viz.SurfaceRenderer(coords, faces, headless=True)
+    colors = renderer.face_colors(stat_map, threshold=threshold, bg_map=bg_map, bg_on_stat=bg_on_stat)
+    np.testing.assert_allclose(colors, _reference_colors(coords, faces, stat_map, bg_map, threshold, bg_on_stat),
+                               atol=1e-12)
+
+
+def test_renderer_reuses_figure(surf, tmp_path):
+    coords, faces = surf
+    renderer = viz.SurfaceRenderer(coords, faces, headless=True)
+    fig, ax = renderer.render(coords[:, 0], bg_map=coords[:, 1])
+    assert renderer.render(coords[:, 2], azim=180) == (fig, ax)
+    assert len(ax.collections) == 1
+    renderer.savefig(str(tmp_path / 'lateral.png'))
+    assert (tmp_path / 'lateral.png').stat().st_size > 0
+
+    with pytest.raises(ValueError):
+        renderer.render(coords[:10, 0])
+
+
+def test_viz_returns_pyplot_figure(surf):
+    coords, faces = surf
+    fig, ax = viz.viz(coords, faces, coords[:, 0], bg_map=coords[:, 1], bg_on_stat=True)
+    assert plt.fignum_exists(fig.number)
+    plt.close(fig)
+
+
+def test_render_batch(surf, tmp_path):
+    coords, faces = surf
+    stat_maps = [coords[:, 0], coords[:, 2]]
+    basenames = [str(tmp_path / ('map%d' % i)) for i in range(2)]
+    montage = str(tmp_path / 'montage.png')
+
+    serial = viz.render_batch(stat_maps, basenames, montage=montage, mesh=surf, figsize=(2, 2), dpi=50,
+                              bg_map=coords[:, 1])
+    assert serial == [b + view for b in basenames for view in ('_0_0.png', '_0_180.png')] + [montage]
+    image = plt.imread(basenames[1] + '_0_180.png')
+    assert image.shape == (100, 100, 4)
+    np.testing.assert_array_equal(plt.imread(montage)[100:, 100:], image)
+
+    # a pool over separate (coords, faces, stat_map) jobs gives the same images
+    parallel_montage = str(tmp_path / 'parallel.png')
+    jobs = [(coords.copy(), faces.copy(), stat_map) for stat_map in stat_maps]
+    assert viz.render_batch(jobs, montage=parallel_montage, n_jobs=2, figsize=(2, 2), dpi=50,
+                            bg_map=coords[:, 1]) == [parallel_montage]
+    np.testing.assert_array_equal(plt.imread(parallel_montage), plt.imread(montage))